@@ -1,17 +1,47 @@
 #!/usr/bin/env python3
 
-import copy
+import contextlib
+import io
+import itertools
 import json
+import os
 import re
-import subprocess
+import stat
+import sys
+import time
+from abc import ABC, abstractmethod
 from enum import Enum as PyEnum
-from typing import Callable
-from urllib import request
+from sys import intern
+
+# Modules only the command line needs (argparse, urllib, concurrent.futures, hashlib, pickle and
+# the profilers) are imported where they are used, so that importing this file as a library to
+# parse specs and print interfaces stays cheap. typing is only needed by type checkers.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+    from typing import Callable, TextIO
 
-VoidFn = Callable[[], None]
 
 CHEATCODES_JSON_URL = "https://raw.githubusercontent.com/foundry-rs/foundry/master/crates/cheatcodes/assets/cheatcodes.json"
 OUT_PATH = "src/Vm.sol"
+SPLIT_DIR = "src/vm"
+SELECTOR_INDEX_NAME = "cheatcode_selectors"
+SELECTOR_INDEX_MAGIC = b"VMSI"
+FOUNDRY_TOML = "foundry.toml"
+VM_TEST_PATH = "test/Vm.t.sol"
+GENERATED_HEADER = "// Automatically @generated by scripts/vm.py. Do not modify manually.\n"
+PY_GENERATED_HEADER = "#" + GENERATED_HEADER.removeprefix("//")
+INPUT_HASH_PREFIX = "// Input hash: "
+SPLIT_FILE_PREFIX = "// Split file: "
+# Statuses of cheatcodes left out of the generated interfaces. Older forge-std releases
+# still include internal cheatcodes.
+STATUS_FILTERS = {
+    "default": ("experimental", "internal"),
+    "keep-internal": ("experimental",),
+}
+MODEL_CACHE_SUBDIR = "models"
+SELECTOR_CACHE_NAME = "selectors.json"
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "forge-std", "cheatcodes")
 
 VM_SAFE_DOC = """\
 /// The `VmSafe` interface does not allow manipulation of the EVM state or other actions that may
@@ -26,37 +56,1098 @@ VM_DOC = """\
 
 
 def main():
-    json_str = request.urlopen(CHEATCODES_JSON_URL).read().decode("utf-8")
-    contract = Cheatcodes.from_json(json_str)
-
-    ccs = contract.cheatcodes
-    ccs = list(filter(lambda cc: cc.status not in ["experimental", "internal"], ccs))
-    ccs.sort(key=lambda cc: cc.func.id)
-
-    safe = list(filter(lambda cc: cc.safety == "safe", ccs))
-    safe.sort(key=CmpCheatcode)
-    unsafe = list(filter(lambda cc: cc.safety == "unsafe", ccs))
-    unsafe.sort(key=CmpCheatcode)
-    assert len(safe) + len(unsafe) == len(ccs)
+    if sys.argv[1:2] == ["diff"]:
+        diff_main(sys.argv[2:])
+        return
 
-    prefix_with_group_headers(safe)
-    prefix_with_group_headers(unsafe)
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
 
-    out = ""
+    parser = argparse.ArgumentParser(
+        description="Generate src/Vm.sol from Foundry's cheatcodes.json",
+        epilog=f"Use `{os.path.basename(sys.argv[0])} diff OLD NEW` to compare two specs instead.",
+    )
+    parser.add_argument("--spec", metavar="PATH", help="read cheatcodes.json from PATH instead of downloading it")
+    parser.add_argument("--url", default=CHEATCODES_JSON_URL, help="where to download cheatcodes.json from")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="directory for downloaded specs")
+    parser.add_argument("--offline", action="store_true", help="only use the last cached download")
+    parser.add_argument(
+        "--no-model-cache",
+        action="store_true",
+        help="parse the spec even if a parsed copy of it is cached",
+    )
+    parser.add_argument("--force", action="store_true", help="regenerate even if the inputs did not change")
+    parser.add_argument("--check", action="store_true", help=f"fail if {OUT_PATH} differs from what would be generated")
+    parser.add_argument(
+        "--target",
+        metavar="DIR[:FILTER]",
+        action="append",
+        help=f"forge-std checkout to generate {OUT_PATH} in, with an optional status filter "
+        f"({', '.join(STATUS_FILTERS)}); can be repeated, defaults to the current directory",
+    )
+    parser.add_argument(
+        "--split",
+        action="store_true",
+        help=f"also emit one file per cheatcode group under {SPLIT_DIR}, for projects that only import the "
+        f"interfaces of some groups; {OUT_PATH} and its interfaceIds stay the same",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="render the interfaces' cheatcode groups in this many processes; only pays off for large specs",
+    )
+    parser.add_argument(
+        "--emit",
+        metavar="BACKEND=PATH",
+        action="append",
+        default=[],
+        help=f"also write bindings for all generated cheatcodes to PATH ({', '.join(EMITTERS)}); can be repeated",
+    )
+    parser.add_argument(
+        "--selector-index",
+        metavar="DIR",
+        help=f"also write a selector to signature index of all cheatcodes to DIR/{SELECTOR_INDEX_NAME}.{{json,bin,py}}",
+    )
+    parser.add_argument(
+        "--no-verify-selectors",
+        action="store_true",
+        help="trust the selectors in the spec instead of checking them against the keccak256 of the signatures",
+    )
+    parser.add_argument(
+        "--fsync",
+        action="store_true",
+        help="flush generated files to disk before moving them into place",
+    )
+    parser.add_argument(
+        "--update-interface-ids",
+        action="store_true",
+        help=f"rewrite the interfaceIds {VM_TEST_PATH} expects once {OUT_PATH} is written, instead of failing "
+        "before anything is written if they changed",
+    )
+    parser.add_argument(
+        "--watch",
+        metavar="PATH",
+        help=f"regenerate {OUT_PATH} in the target whenever the spec at PATH changes, until interrupted",
+    )
+    parser.add_argument("--profile", action="store_true", help="report the time spent in each phase")
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="like --profile, and also trace the memory each phase allocates; tracing slows every phase down "
+        "several times, so the times it reports are not comparable with those of --profile alone",
+    )
+    parser.add_argument(
+        "--profile-dump",
+        metavar="DIR",
+        help="like --profile, and also write cProfile stats of each run to DIR, and with --profile-memory a "
+        "tracemalloc snapshot; profiling slows the phases down too",
+    )
+    args = parser.parse_args()
+    # Both only refine the report, so asking for them asks for the report.
+    args.profile = args.profile or args.profile_memory or args.profile_dump is not None
+    # Checked before anything is written, so that a typo does not leave earlier outputs behind.
+    for emit in args.emit:
+        backend, _, path = emit.partition("=")
+        if backend not in EMITTERS or path == "":
+            parser.error(f"--emit expects BACKEND=PATH with BACKEND one of {', '.join(EMITTERS)}, got {emit}")
+
+    targets = [parse_target(t) for t in args.target or ["."]]
+    if args.watch:
+        assert len(targets) == 1 and not args.split, "--watch supports a single target without --split"
+        selector_cache = None if args.no_verify_selectors else os.path.join(args.cache_dir, SELECTOR_CACHE_NAME)
+        watch(
+            args.watch,
+            *targets[0],
+            fsync=args.fsync,
+            update_ids=args.update_interface_ids,
+            selector_cache=selector_cache,
+        )
+        return
+
+    phases = Phases.for_run(args.profile, args.profile_memory, args.profile_dump, "main")
+    options = dict(
+        check=args.check,
+        split=args.split,
+        jobs=args.jobs,
+        fsync=args.fsync,
+        update_ids=args.update_interface_ids,
+        profile=args.profile,
+        profile_memory=args.profile_memory,
+        profile_dump=args.profile_dump,
+    )
 
-    out += "// Automatically @generated by scripts/vm.py. Do not modify manually.\n\n"
+    if args.spec:
+        with phases("fetch"), open(args.spec, "rb") as f:
+            spec = f.read()
+    else:
+        with phases("fetch"):
+            spec = SpecCache(args.cache_dir).fetch(args.url, offline=args.offline).encode("utf-8")
+
+    # Targets generated from the same inputs are skipped before the spec is even parsed.
+    with phases("input hash"):
+        digests = [target_digest(spec, *target, args.split) for target in targets]
+        pending = []
+        for target, digest in zip(targets, digests):
+            if not args.force and not args.check and is_up_to_date(target[0], digest):
+                print(f"{os.path.normpath(os.path.join(target[0], OUT_PATH))} is up to date")
+            else:
+                pending.append((*target, digest))
+    if not pending and not args.selector_index and not args.emit:
+        if args.profile:
+            print(phases.report())
+        return
+
+    with phases("parse"):
+        if args.no_model_cache:
+            contract = Cheatcodes.from_json(spec).materialize()
+        else:
+            contract = ModelCache(os.path.join(args.cache_dir, MODEL_CACHE_SUBDIR)).load(spec)
+    if not args.no_verify_selectors:
+        with phases("verify selectors"):
+            verify_selectors(contract.cheatcodes, os.path.join(args.cache_dir, SELECTOR_CACHE_NAME))
+
+    if args.selector_index:
+        with phases("selector index"):
+            entries = selector_index(contract.cheatcodes)
+            print(write_selector_index(args.selector_index, entries, fsync=args.fsync))
+
+    if args.emit:
+        with phases("emit"):
+            safe, unsafe = partition_cheatcodes(contract.cheatcodes)
+            bindings = Cheatcodes(contract.errors, contract.events, contract.enums, contract.structs, safe + unsafe)
+            for emit in args.emit:
+                backend, _, path = emit.partition("=")
+                with atomic_write(path, fsync=args.fsync) as f:
+                    EMITTERS[backend]().emit(bindings, f)
+                print(f"Wrote {backend} bindings to {path}")
+
+    if len(pending) == 1:
+        print(generate(contract, *pending[0], **options))
+    elif pending:
+        # The spec is parsed once and shipped to each worker, which filters, renders and writes its target.
+        with ProcessPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 1)) as pool:
+            futures = [pool.submit(generate, contract, *target, **options) for target in pending]
+            for future in futures:
+                print(future.result())
+
+    if args.profile:
+        print(phases.report())
+
+
+def diff_main(argv: list[str]):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=f"{os.path.basename(sys.argv[0])} diff",
+        description="Compare the cheatcodes of two cheatcodes.json snapshots",
+    )
+    parser.add_argument("old", help="path to the old cheatcodes.json")
+    parser.add_argument("new", help="path to the new cheatcodes.json")
+    parser.add_argument(
+        "--filter",
+        choices=list(STATUS_FILTERS),
+        default="default",
+        help="status filter deciding which cheatcodes are part of the interfaces",
+    )
+    parser.add_argument("--check", action="store_true", help="fail if the interfaces differ")
+    parser.add_argument("--allow-added", action="store_true", help="with --check, do not fail on added cheatcodes")
+    args = parser.parse_args(argv)
+
+    old = Cheatcodes.from_json_file(args.old)
+    new = Cheatcodes.from_json_file(args.new)
+    d = SpecDiff(old.cheatcodes, new.cheatcodes, STATUS_FILTERS[args.filter])
+    print(d.report())
+    if args.check:
+        assert not d.affects_interfaces(args.allow_added), f"{args.old} and {args.new} differ"
+
+
+def parse_target(s: str) -> tuple[str, str]:
+    root, sep, status_filter = s.rpartition(":")
+    if sep == "" or status_filter not in STATUS_FILTERS:
+        return s, "default"
+    return root, status_filter
+
+
+# Generates `OUT_PATH` under the forge-std checkout at `root` and returns what was done.
+# `digest` is the `target_digest` of the spec `contract` was parsed from.
+def generate(
+    contract: "Cheatcodes",
+    root: str,
+    status_filter: str,
+    digest: str,
+    check: bool = False,
+    split: bool = False,
+    jobs: int = 1,
+    fsync: bool = False,
+    update_ids: bool = False,
+    profile: bool = False,
+    profile_memory: bool = False,
+    profile_dump: str | None = None,
+) -> str:
+    out_path = os.path.normpath(os.path.join(root, OUT_PATH))
+    phases = Phases.for_run(profile, profile_memory, profile_dump, os.path.basename(os.path.abspath(root)))
+    msg = generate_phases(
+        contract, root, out_path, status_filter, digest, check, split, jobs, fsync, update_ids, phases
+    )
+    if profile:
+        msg += "\n" + phases.report()
+    return msg
+
+
+# The expected interface IDs in `VM_TEST_PATH` are verified before anything is written, unless
+# `update_ids` asks for them to be rewritten, which only happens once `OUT_PATH` has been written.
+def generate_phases(
+    contract: "Cheatcodes",
+    root: str,
+    out_path: str,
+    status_filter: str,
+    digest: str,
+    check: bool,
+    split: bool,
+    jobs: int,
+    fsync: bool,
+    update_ids: bool,
+    phases: "Phases",
+) -> str:
+    with phases("filter + sort"):
+        safe, unsafe = partition_cheatcodes(contract.cheatcodes, STATUS_FILTERS[status_filter])
+
+    printer_options = vm_printer_options(root)
+    update_ids = update_ids and not check
+    with phases("interface ids"):
+        ids = {"VmSafe": interface_id(safe), "Vm": interface_id(unsafe)}
+        test_path = os.path.normpath(os.path.join(root, VM_TEST_PATH))
+        if not update_ids:
+            test_msg = update_interface_ids(test_path, ids)
+
+    msg = write_outputs(
+        contract, root, out_path, safe, unsafe, digest, printer_options, check, split, jobs, fsync, phases
+    )
 
-    pp = CheatcodesPrinter(
+    if update_ids:
+        test_msg = update_interface_ids(test_path, ids, update=True, fsync=fsync)
+    return msg + test_msg
+
+
+# Writes, or with `check` verifies, `OUT_PATH` and with `split` the split files, and returns what was done.
+def write_outputs(
+    contract: "Cheatcodes",
+    root: str,
+    out_path: str,
+    safe: list["Cheatcode"],
+    unsafe: list["Cheatcode"],
+    digest: str,
+    printer_options: dict,
+    check: bool,
+    split: bool,
+    jobs: int,
+    fsync: bool,
+    phases: "Phases",
+) -> str:
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=jobs)
+    try:
+        if split:
+            with phases("print"):
+                files = render_split(contract, safe, unsafe, printer_options)
+                out = io.StringIO()
+                write_vm(out, contract, safe, unsafe, digest, printer_options, executor, header=split_manifest(files))
+                # Written last, so that its input hash only changes once the split files are in place.
+                files[OUT_PATH] = out.getvalue()
+            with phases("write"):
+                changed = sync_split(root, files, check, fsync)
+            if len(changed) == 0:
+                return f"{out_path} is up to date"
+            assert not check, f"out of date: {', '.join(changed)}"
+            return f"Updated {', '.join(changed)}"
+
+        if check:
+            stale = sync_split(root, {}, check)
+            assert not stale, f"out of date: {', '.join(stale)}"
+            with phases("print"):
+                out = io.StringIO()
+                write_vm(out, contract, safe, unsafe, digest, printer_options, executor)
+            with open(out_path, "r") as f:
+                current = f.read()
+            assert strip_input_hash(current) == strip_input_hash(out.getvalue()), f"{out_path} is out of date"
+            return f"{out_path} is up to date"
+
+        # Declarations are written out as they are printed, so the two are timed together.
+        with phases("print + write"), atomic_write(out_path, fsync=fsync) as f:
+            write_vm(f, contract, safe, unsafe, digest, printer_options, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Split files left over from a `--split` run would still be importable, but go stale.
+    removed = sync_split(root, {}, check, fsync)
+    if removed:
+        return f"Wrote to {out_path} and removed {', '.join(removed)}"
+    return f"Wrote to {out_path}"
+
+
+def vm_printer_options(root: str) -> dict:
+    return dict(
         spdx_identifier="MIT OR Apache-2.0",
         solidity_requirement=">=0.6.2 <0.9.0",
         abicoder_pragma=True,
+        memory_to_calldata=True,
+        group_headers=True,
+        **fmt_options(os.path.join(root, FOUNDRY_TOML)),
     )
+
+
+# Polls the spec at `spec_path` and regenerates `OUT_PATH` under `root` each time it changes.
+# The parsed cheatcodes and the rendered groups are kept between runs, so an edit only re-parses
+# the cheatcodes and re-prints the groups it touches, and `OUT_PATH` is only rewritten if it changed.
+# Selectors are verified against `selector_cache` as in `ResidentModel.update`, and the interface
+# IDs as in `generate_phases`.
+def watch(
+    spec_path: str,
+    root: str,
+    status_filter: str,
+    fsync: bool = False,
+    update_ids: bool = False,
+    selector_cache: str | None = None,
+    interval: float = 0.05,
+):
+    out_path = os.path.normpath(os.path.join(root, OUT_PATH))
+    test_path = os.path.normpath(os.path.join(root, VM_TEST_PATH))
+    model = ResidentModel()
+    group_cache = GroupCache()
+    last_seen = None
+    print(f"Watching {spec_path}, press Ctrl-C to stop")
+    try:
+        while True:
+            try:
+                st = os.stat(spec_path)
+                seen = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                seen = None
+            if seen is None or seen == last_seen:
+                time.sleep(interval)
+                continue
+            last_seen = seen
+
+            start = time.perf_counter()
+            try:
+                with open(spec_path, "rb") as f:
+                    spec = f.read()
+                contract = model.update(spec, selector_cache)
+                safe, unsafe = partition_cheatcodes(contract.cheatcodes, STATUS_FILTERS[status_filter])
+                printer_options = vm_printer_options(root)
+                digest = input_hash(spec, status_filter, printer_options, False)
+                out = io.StringIO()
+                write_vm(out, contract, safe, unsafe, digest, printer_options, group_cache=group_cache)
+                ids = {"VmSafe": interface_id(safe), "Vm": interface_id(unsafe)}
+                if not update_ids:
+                    test_msg = update_interface_ids(test_path, ids)
+            except Exception as e:
+                # Most likely caught in the middle of an edit, which can break the spec in any number
+                # of ways; nothing has been written, and the next save will be picked up.
+                print(f"error: {spec_path}: {e!r}", file=sys.stderr)
+                continue
+
+            try:
+                with open(out_path, "r") as f:
+                    changed = f.read() != out.getvalue()
+            except FileNotFoundError:
+                changed = True
+            if changed:
+                with atomic_write(out_path, fsync=fsync) as f:
+                    f.write(out.getvalue())
+            # Only updated once `OUT_PATH` is written, so that it never asserts IDs `OUT_PATH` lacks.
+            if update_ids:
+                test_msg = update_interface_ids(test_path, ids, update=True, fsync=fsync)
+            elapsed = (time.perf_counter() - start) * 1000
+            action = "Wrote to" if changed else "Unchanged"
+            print(
+                f"{action} {out_path}{test_msg}, re-parsed {model.misses} cheatcodes"
+                f" and re-rendered {group_cache.misses} groups in {elapsed:.0f} ms"
+            )
+    except KeyboardInterrupt:
+        pass
+
+
+# Instrumentation around the phases of a run: `with phases("name"):` calls each hook's `enter`
+# and `exit` around the block. Without hooks it costs a context manager per phase.
+class Phases:
+    label: str
+    hooks: list["PhaseHook"]
+
+    def __init__(self, label: str = "", hooks: list["PhaseHook"] | None = None):
+        self.label = label
+        self.hooks = hooks or []
+
+    # The hooks for `--profile`, `--profile-memory` and `--profile-dump`, with dumps named after `label`.
+    @staticmethod
+    def for_run(profile: bool, memory: bool, dump_dir: str | None, label: str) -> "Phases":
+        if not profile:
+            return Phases(label)
+        hooks = [TimingHook(memory)]
+        if dump_dir is not None:
+            hooks.append(DumpHook(dump_dir, label))
+        return Phases(label, hooks)
+
+    @contextlib.contextmanager
+    def __call__(self, name: str):
+        for hook in self.hooks:
+            hook.enter(name)
+        try:
+            yield
+        finally:
+            for hook in reversed(self.hooks):
+                hook.exit(name)
+
+    def report(self) -> str:
+        reports = [r for r in (hook.report() for hook in self.hooks) if r != ""]
+        return "\n".join([f"Profile of {self.label}:"] + reports)
+
+
+class PhaseHook:
+    def enter(self, name: str):
+        pass
+
+    def exit(self, name: str):
+        pass
+
+    def report(self) -> str:
+        return ""
+
+
+# Wall time, memory allocated and peak traced memory of each phase.
+class TimingHook(PhaseHook):
+    # Whether to also trace memory, which makes the traced code several times slower.
+    trace_memory: bool
+    # Name, seconds, and with `trace_memory` the bytes still allocated at the end and the peak
+    # bytes, in the order phases ran.
+    phases: list[tuple[str, float, int | None, int | None]]
+    _start: float
+    _allocated: int
+
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        self.phases = []
+
+    def enter(self, name: str):
+        if self.trace_memory:
+            import tracemalloc
+
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._allocated = tracemalloc.get_traced_memory()[0]
+        self._start = time.perf_counter()
+
+    def exit(self, name: str):
+        elapsed = time.perf_counter() - self._start
+        if not self.trace_memory:
+            self.phases.append((name, elapsed, None, None))
+            return
+
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        self.phases.append((name, elapsed, current - self._allocated, peak - self._allocated))
+
+    def report(self) -> str:
+        lines = []
+        for name, elapsed, allocated, peak in self.phases:
+            line = f"  {name:<16} {elapsed * 1000:10.1f} ms"
+            if allocated is not None:
+                line += f" {allocated / 2**20:8.1f} MiB retained {peak / 2**20:8.1f} MiB peak"
+            lines.append(line)
+        total = sum(elapsed for _, elapsed, _, _ in self.phases)
+        lines.append(f"  {'total':<16} {total * 1000:10.1f} ms")
+        return "\n".join(lines)
+
+
+# Profiles all phases with cProfile, and snapshots traced memory after the last one if it is traced.
+class DumpHook(PhaseHook):
+    dir: str
+    label: str
+    profile: "cProfile.Profile"
+
+    def __init__(self, dir: str, label: str):
+        self.dir = dir
+        self.label = label
+        import cProfile
+
+        self.profile = cProfile.Profile()
+
+    def enter(self, name: str):
+        self.profile.enable()
+
+    def exit(self, name: str):
+        self.profile.disable()
+
+    def report(self) -> str:
+        import tracemalloc
+
+        os.makedirs(self.dir, exist_ok=True)
+        prof_path = os.path.join(self.dir, f"{self.label}.prof")
+        self.profile.dump_stats(prof_path)
+        if not tracemalloc.is_tracing():
+            return f"  wrote {prof_path}"
+        snapshot_path = os.path.join(self.dir, f"{self.label}.tracemalloc")
+        tracemalloc.take_snapshot().dump(snapshot_path)
+        return f"  wrote {prof_path} and {snapshot_path}"
+
+
+# Renders the split layout: `VmTypes` with the shared events, enums and structs, and one file per
+# group with `VmSafe<Group>` and `Vm<Group>`, both inheriting `VmTypes`. They are emitted alongside
+# `OUT_PATH`, which still declares every function itself, so that its interfaces and their
+# `interfaceId`s do not depend on the layout. Returns the contents keyed by path under the root.
+def render_split(
+    contract: "Cheatcodes",
+    safe: list["Cheatcode"],
+    unsafe: list["Cheatcode"],
+    printer_options: dict,
+) -> dict[str, str]:
+    # Each file holds a single group, which needs no header.
+    printer_options = dict(printer_options, group_headers=False)
+
+    def render(name: str, imports: list[str], p: "Callable[[CheatcodesPrinter], None]") -> str:
+        out = io.StringIO()
+        out.write(GENERATED_HEADER)
+        out.write("\n")
+        pp = CheatcodesPrinter(out=out, **printer_options)
+        pp.p_prelude()
+        pp.prelude = False
+        for path in imports:
+            rel = os.path.relpath(path, os.path.dirname(name))
+            if not rel.startswith("."):
+                rel = "./" + rel
+            pp.p_import(split_interfaces[path], rel)
+        pp.finish()
+        out.write("\n\n")
+        p(pp)
+        pp.finish()
+        out.write(pp.nl_str)
+        return out.getvalue()
+
+    def types(pp: CheatcodesPrinter):
+        pp.p_contract(Cheatcodes([], contract.events, contract.enums, contract.structs, []), "VmTypes")
+
+    types_path = f"{SPLIT_DIR}/VmTypes.sol"
+    split_interfaces = {types_path: ["VmTypes"]}
+    files = {types_path: render(types_path, [], types)}
+
+    groups = {}
+    for cc in safe + unsafe:
+        groups.setdefault(cc.group, ([], []))[cc.safety == "unsafe"].append(cc)
+    for g in sorted(groups):
+        group_safe, group_unsafe = groups[g]
+        interfaces = []
+        if group_safe:
+            interfaces.append(f"VmSafe{group(g)}")
+        if group_unsafe:
+            interfaces.append(f"Vm{group(g)}")
+
+        def p(pp: CheatcodesPrinter, group_safe=group_safe, group_unsafe=group_unsafe, g=g):
+            if group_safe:
+                pp.p_contract(Cheatcodes([], [], [], [], group_safe), f"VmSafe{group(g)}", "VmTypes")
+                pp.finish()
+            if group_safe and group_unsafe:
+                pp.out.write("\n\n")
+            if group_unsafe:
+                pp.p_contract(Cheatcodes([], [], [], [], group_unsafe), f"Vm{group(g)}", "VmTypes")
+                pp.finish()
+
+        path = f"{SPLIT_DIR}/Vm{group(g)}.sol"
+        assert path not in files, f"group {g} would overwrite {path}"
+        split_interfaces[path] = interfaces
+        files[path] = render(path, [types_path], p)
+    return files
+
+
+# The header lines listing the split `files` in `OUT_PATH`, with the SHA-256 of each, so that
+# `is_up_to_date` notices when one was changed or deleted.
+def split_manifest(files: dict[str, str]) -> str:
+    import hashlib
+
+    lines = []
+    for path, content in files.items():
+        lines.append(f"{SPLIT_FILE_PREFIX}{path} {hashlib.sha256(content.encode('utf-8')).hexdigest()}\n")
+    return "".join(lines)
+
+
+# Writes the files under `root` that differ from what is there, and removes generated files under
+# `SPLIT_DIR` that are not among them. Returns the paths that changed. With `check`, nothing is
+# written and files that only differ in their input hash count as unchanged.
+def sync_split(root: str, files: dict[str, str], check: bool, fsync: bool = False) -> list[str]:
+    changed = []
+    split_dir = os.path.join(root, SPLIT_DIR)
+    if os.path.isdir(split_dir):
+        for name in sorted(os.listdir(split_dir)):
+            path = f"{SPLIT_DIR}/{name}"
+            if path in files or not name.endswith(".sol"):
+                continue
+            with open(os.path.join(root, path), "r") as f:
+                if f.readline() != GENERATED_HEADER:
+                    continue
+            changed.append(os.path.normpath(os.path.join(root, path)))
+            if not check:
+                os.remove(os.path.join(root, path))
+        if not check and not os.listdir(split_dir):
+            os.rmdir(split_dir)
+
+    for path, content in files.items():
+        full_path = os.path.normpath(os.path.join(root, path))
+        try:
+            with open(full_path, "r") as f:
+                current = f.read()
+        except FileNotFoundError:
+            current = None
+        same = current == content
+        if check and current is not None:
+            same = strip_input_hash(current) == strip_input_hash(content)
+        if same:
+            continue
+        changed.append(full_path)
+        if not check:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with atomic_write(full_path, fsync=fsync) as f:
+                f.write(content)
+    return changed
+
+
+# Checks that the selector of every cheatcode is the start of the keccak256 of its signature.
+# The selector of each signature hashed so far is kept in the JSON object at `cache_path`, so
+# only signatures new to the cache are hashed, all in one batch. Returns how many were hashed.
+def verify_selectors(cheatcodes: list["Cheatcode"], cache_path: str | None = None) -> int:
+    known = {}
+    if cache_path is not None:
+        try:
+            with open(cache_path, "r") as f:
+                known = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    new = sorted({cc.func.signature for cc in cheatcodes} - known.keys())
+    if new:
+        digests = keccak256_batch_impl()([signature.encode("utf-8") for signature in new])
+        for signature, digest in zip(new, digests):
+            known[signature] = "0x" + digest[:4].hex()
+        if cache_path is not None:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            with atomic_write(cache_path) as f:
+                json.dump(known, f, indent=2, sort_keys=True)
+
+    mismatches = [
+        f"{cc.func.id}: selector of {cc.func.signature} is {known[cc.func.signature]}, spec says {cc.func.selector}"
+        for cc in cheatcodes
+        if known[cc.func.signature] != cc.func.selector
+    ]
+    assert not mismatches, "wrong selectors in spec:\n" + "\n".join(mismatches)
+    return len(new)
+
+
+# The fastest batch keccak256 available: pycryptodome or eth-hash if installed, otherwise the
+# pure Python `keccak256_batch`. `hashlib.sha3_256` cannot be used, SHA-3 pads differently.
+def keccak256_batch_impl() -> "Callable[[list[bytes]], list[bytes]]":
+    try:
+        from Crypto.Hash import keccak
+
+        pycryptodome = lambda messages: [keccak.new(digest_bits=256, data=m).digest() for m in messages]
+        if pycryptodome([b""]) == [KECCAK256_EMPTY]:
+            return pycryptodome
+    except ImportError:
+        pass
+    try:
+        # eth-hash only looks for one of its backends on the first hash, so probe it here.
+        from eth_hash.auto import keccak
+
+        if keccak(b"") == KECCAK256_EMPTY:
+            return lambda messages: [keccak(m) for m in messages]
+    except ImportError:
+        pass
+    return keccak256_batch
+
+
+KECCAK256_EMPTY = bytes.fromhex("c5d2460186f7233c927e7db2dcc703c0e500b653ca82273b7bfad8045d85a470")
+KECCAK_ROUND_CONSTANTS = [
+    0x0000000000000001,
+    0x0000000000008082,
+    0x800000000000808A,
+    0x8000000080008000,
+    0x000000000000808B,
+    0x0000000080000001,
+    0x8000000080008081,
+    0x8000000000008009,
+    0x000000000000008A,
+    0x0000000000000088,
+    0x0000000080008009,
+    0x000000008000000A,
+    0x000000008000808B,
+    0x800000000000008B,
+    0x8000000000008089,
+    0x8000000000008003,
+    0x8000000000008002,
+    0x8000000000000080,
+    0x000000000000800A,
+    0x800000008000000A,
+    0x8000000080008081,
+    0x8000000000008080,
+    0x0000000080000001,
+    0x8000000080008008,
+]
+# Rotation of each lane in the rho step, lanes indexed by `x + 5 * y`.
+KECCAK_ROTATIONS = [0, 1, 62, 28, 27, 36, 44, 6, 55, 20, 3, 10, 43, 25, 39, 41, 45, 15, 21, 8, 18, 2, 61, 56, 14]
+# `(source lane, destination lane, rotation)` of the combined rho and pi steps.
+KECCAK_RHO_PI = [
+    (x + 5 * y, y + 5 * ((2 * x + 3 * y) % 5), KECCAK_ROTATIONS[x + 5 * y]) for y in range(5) for x in range(5)
+]
+KECCAK_RATE = 136
+
+
+def keccak256(data: bytes) -> bytes:
+    return keccak256_batch([data])[0]
+
+
+# Hashes messages with the same number of blocks together: lane `i` of the state of all of them
+# is held in one integer, with message `k` in bits `64 * k` to `64 * k + 63`, so that each step
+# of the permutation is a handful of big integer operations for the whole batch.
+def keccak256_batch(messages: list[bytes]) -> list[bytes]:
+    by_blocks: dict[int, list[int]] = {}
+    for i, m in enumerate(messages):
+        by_blocks.setdefault(len(m) // KECCAK_RATE + 1, []).append(i)
+
+    digests = [b""] * len(messages)
+    for blocks, indices in by_blocks.items():
+        padded = []
+        for i in indices:
+            p = bytearray(messages[i])
+            p.append(0x01)
+            p.extend(bytes(blocks * KECCAK_RATE - len(p)))
+            p[-1] |= 0x80
+            padded.append(p)
+
+        n = len(indices)
+        lanes = [0] * 25
+        for block in range(blocks):
+            for lane in range(KECCAK_RATE // 8):
+                start = block * KECCAK_RATE + lane * 8
+                lanes[lane] ^= int.from_bytes(b"".join(p[start : start + 8] for p in padded), "little")
+            keccak_f(lanes, n)
+
+        out = [lane.to_bytes(8 * n, "little") for lane in lanes[:4]]
+        for k, i in enumerate(indices):
+            digests[i] = b"".join(o[8 * k : 8 * k + 8] for o in out)
+    return digests
+
+
+# The Keccak-f[1600] permutation, in place on 25 lanes of `n` interleaved 64-bit words each.
+def keccak_f(a: list[int], n: int = 1):
+    hi, lo, round_constants = keccak_masks(n)
+    b = [0] * 25
+    for rc in round_constants:
+        c0 = a[0] ^ a[5] ^ a[10] ^ a[15] ^ a[20]
+        c1 = a[1] ^ a[6] ^ a[11] ^ a[16] ^ a[21]
+        c2 = a[2] ^ a[7] ^ a[12] ^ a[17] ^ a[22]
+        c3 = a[3] ^ a[8] ^ a[13] ^ a[18] ^ a[23]
+        c4 = a[4] ^ a[9] ^ a[14] ^ a[19] ^ a[24]
+        d = (
+            c4 ^ ((c1 << 1) & hi[1]) ^ ((c1 >> 63) & lo[1]),
+            c0 ^ ((c2 << 1) & hi[1]) ^ ((c2 >> 63) & lo[1]),
+            c1 ^ ((c3 << 1) & hi[1]) ^ ((c3 >> 63) & lo[1]),
+            c2 ^ ((c4 << 1) & hi[1]) ^ ((c4 >> 63) & lo[1]),
+            c3 ^ ((c0 << 1) & hi[1]) ^ ((c0 >> 63) & lo[1]),
+        )
+        for src, dst, rot in KECCAK_RHO_PI:
+            v = a[src] ^ d[src % 5]
+            b[dst] = ((v << rot) & hi[rot]) | ((v >> (64 - rot)) & lo[rot])
+        for y in range(0, 25, 5):
+            b0, b1, b2, b3, b4 = b[y : y + 5]
+            a[y] = b0 ^ (~b1 & b2)
+            a[y + 1] = b1 ^ (~b2 & b3)
+            a[y + 2] = b2 ^ (~b3 & b4)
+            a[y + 3] = b3 ^ (~b4 & b0)
+            a[y + 4] = b4 ^ (~b0 & b1)
+        a[0] ^= rc
+
+
+# For `n` interleaved words and each rotation `r`: the bits of each word left of bit `r`, the
+# bits right of it, and the round constants repeated in every word.
+def keccak_masks(n: int) -> tuple[list[int], list[int], list[int]]:
+    masks = _keccak_masks.get(n)
+    if masks is None:
+        repeat = lambda word: int.from_bytes(word.to_bytes(8, "little") * n, "little")
+        word = (1 << 64) - 1
+        hi = [repeat((word << r) & word) for r in range(64)]
+        lo = [repeat((1 << r) - 1) for r in range(64)]
+        masks = (hi, lo, [repeat(rc) for rc in KECCAK_ROUND_CONSTANTS])
+        _keccak_masks[n] = masks
+    return masks
+
+
+_keccak_masks: dict[int, tuple[list[int], list[int], list[int]]] = {}
+
+
+# Sorted `(selector, signature)` pairs for every cheatcode in the spec, whatever its status,
+# since any of them can show up in a trace.
+def selector_index(cheatcodes: list["Cheatcode"]) -> list[tuple[bytes, str]]:
+    index = {}
+    for cc in cheatcodes:
+        selector = cc.func.selector_bytes
+        other = index.setdefault(selector, cc.func.signature)
+        assert other == cc.func.signature, (
+            f"selector collision: 0x{selector.hex()} is both {other} and {cc.func.signature}"
+        )
+    return sorted(index.items())
+
+
+def write_selector_index(dir: str, entries: list[tuple[bytes, str]], fsync: bool = False) -> str:
+    os.makedirs(dir, exist_ok=True)
+    base = os.path.join(dir, SELECTOR_INDEX_NAME)
+    with atomic_write(base + ".json", fsync=fsync) as f:
+        json.dump({"0x" + selector.hex(): signature for selector, signature in entries}, f, indent=2)
+        f.write("\n")
+    with atomic_write(base + ".bin", "wb", fsync=fsync) as f:
+        f.write(encode_selector_index(entries))
+    with atomic_write(base + ".py", fsync=fsync) as f:
+        f.write(PY_GENERATED_HEADER + "\n")
+        f.write("SIGNATURES: dict[int, str] = {\n")
+        for selector, signature in entries:
+            f.write(f"    0x{selector.hex()}: {signature!r},\n")
+        f.write("}\n\n\n")
+        f.write("def signature(selector: bytes) -> str | None:\n")
+        f.write('    return SIGNATURES.get(int.from_bytes(selector[:4], "big"))\n')
+    return f"Wrote {len(entries)} selectors to {base}.{{json,bin,py}}"
+
+
+# Binary form of the selector index, all integers big-endian:
+#   magic "VMSI" | count: u32 | count sorted selectors: 4 bytes each
+#   | count + 1 offsets into the string table: u32 each | UTF-8 signatures, concatenated
+# The selectors can be binary searched in place; signature `i` is `strings[offsets[i]:offsets[i + 1]]`.
+def encode_selector_index(entries: list[tuple[bytes, str]]) -> bytes:
+    strings = [signature.encode("utf-8") for _, signature in entries]
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    out = bytearray(SELECTOR_INDEX_MAGIC)
+    out += len(entries).to_bytes(4, "big")
+    for selector, _ in entries:
+        out += selector
+    for offset in offsets:
+        out += offset.to_bytes(4, "big")
+    out += b"".join(strings)
+    return bytes(out)
+
+
+def lookup_selector_index(data: bytes, selector: bytes) -> str | None:
+    assert data[:4] == SELECTOR_INDEX_MAGIC, "not a selector index"
+    count = int.from_bytes(data[4:8], "big")
+    selectors = 8
+    offsets = selectors + 4 * count
+    strings = offsets + 4 * (count + 1)
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        s = data[selectors + 4 * mid : selectors + 4 * mid + 4]
+        if s < selector:
+            lo = mid + 1
+        elif s > selector:
+            hi = mid
+        else:
+            start = int.from_bytes(data[offsets + 4 * mid : offsets + 4 * mid + 4], "big")
+            end = int.from_bytes(data[offsets + 4 * mid + 4 : offsets + 4 * mid + 8], "big")
+            return data[strings + start : strings + end].decode("utf-8")
+    return None
+
+
+# `type(I).interfaceId` is the XOR of the selectors of the functions declared in `I` itself,
+# so it can be computed from the spec without compiling anything.
+def interface_id(cheatcodes: list["Cheatcode"]) -> bytes:
+    ret = 0
+    for cc in cheatcodes:
+        ret ^= int.from_bytes(cc.func.selector_bytes, "big")
+    return ret.to_bytes(4, "big")
+
+
+# Verifies, or with `update` rewrites, the expected interface IDs asserted in `VM_TEST_PATH`.
+# They guard against functions being removed or moved by accident, so they are only rewritten
+# when asked to.
+def update_interface_ids(path: str, ids: dict[str, bytes], update: bool = False, fsync: bool = False) -> str:
+    try:
+        with open(path, "r") as f:
+            current = f.read()
+    except FileNotFoundError:
+        return ""
+
+    def replace(m: re.Match) -> str:
+        return f"{m.group(1)}0x{ids[m.group(2)].hex()}{m.group(3)}"
+
+    updated = re.sub(r"(type\((VmSafe|Vm)\)\.interfaceId, bytes4\()0x[0-9a-fA-F]{8}(\))", replace, current)
+    summary = ", ".join(f"{name} interfaceId 0x{id.hex()}" for name, id in ids.items())
+    if updated == current:
+        return f" ({summary})"
+    assert update, f"{path} expects other interface IDs than {summary}; use --update-interface-ids if that is intended"
+    with atomic_write(path, fsync=fsync) as f:
+        f.write(updated)
+    return f" (updated {path}: {summary})"
+
+
+# The interface `cc` is generated in, or "-" if its status leaves it out.
+def interface_of(cc: "Cheatcode", excluded_statuses: tuple[str, ...]) -> str:
+    if cc.status in excluded_statuses:
+        return "-"
+    return "VmSafe" if cc.safety == "safe" else "Vm"
+
+
+# Differences between the cheatcodes of two specs, matched by `func.id`. Cheatcodes only found
+# in one spec but sharing a selector are reported as renamed rather than removed and added.
+class SpecDiff:
+    # Fields of `Function` that make a cheatcode count as changed.
+    FIELDS = ["declaration", "signature", "selector", "visibility", "mutability", "description"]
+
+    added: list["Cheatcode"]
+    removed: list["Cheatcode"]
+    renamed: list[tuple["Cheatcode", "Cheatcode"]]
+    # Old and new cheatcode, and the names of the fields that differ.
+    changed: list[tuple["Cheatcode", "Cheatcode", list[str]]]
+    # Old and new cheatcode, and the old and new interface.
+    moved: list[tuple["Cheatcode", "Cheatcode", str, str]]
+    # Old and new ID of each interface.
+    interface_ids: dict[str, tuple[bytes, bytes]]
+    excluded_statuses: tuple[str, ...]
+
+    def __init__(self, old: list["Cheatcode"], new: list["Cheatcode"], excluded_statuses: tuple[str, ...]):
+        self.excluded_statuses = excluded_statuses
+        self.added = []
+        self.removed = []
+        self.renamed = []
+        self.changed = []
+        self.moved = []
+
+        old_by_id = {cc.func.id: cc for cc in old}
+        new_by_id = {cc.func.id: cc for cc in new}
+        for cc in old:
+            other = new_by_id.get(cc.func.id)
+            if other is None:
+                self.removed.append(cc)
+            else:
+                self._compare(cc, other)
+        self.added = [cc for cc in new if cc.func.id not in old_by_id]
+
+        added_by_selector = {cc.func.selector: cc for cc in self.added}
+        removed = []
+        for cc in self.removed:
+            other = added_by_selector.pop(cc.func.selector, None)
+            if other is None:
+                removed.append(cc)
+                continue
+            self.renamed.append((cc, other))
+            self._compare(cc, other)
+        renamed = {id(other) for _, other in self.renamed}
+        self.added = [cc for cc in self.added if id(cc) not in renamed]
+        self.removed = removed
+
+        old_safe, old_unsafe = partition_cheatcodes(old, excluded_statuses)
+        new_safe, new_unsafe = partition_cheatcodes(new, excluded_statuses)
+        self.interface_ids = {
+            "VmSafe": (interface_id(old_safe), interface_id(new_safe)),
+            "Vm": (interface_id(old_unsafe), interface_id(new_unsafe)),
+        }
+
+    def _compare(self, old: "Cheatcode", new: "Cheatcode"):
+        fields = [name for name in self.FIELDS if getattr(old.func, name) != getattr(new.func, name)]
+        fields += [name for name in ["group", "status", "safety"] if getattr(old, name) != getattr(new, name)]
+        if fields:
+            self.changed.append((old, new, fields))
+        old_interface = interface_of(old, self.excluded_statuses)
+        new_interface = interface_of(new, self.excluded_statuses)
+        if old_interface != new_interface:
+            self.moved.append((old, new, old_interface, new_interface))
+
+    # Whether the generated interfaces differ. With `ignore_added`, cheatcodes that were added
+    # to an interface, or moved into one from a filtered status, do not count.
+    def affects_interfaces(self, ignore_added: bool = False) -> bool:
+        visible = lambda cc: interface_of(cc, self.excluded_statuses) != "-"
+        added = any(map(visible, self.added)) or any(old == "-" for _, _, old, _ in self.moved)
+        return (
+            (added and not ignore_added)
+            or any(map(visible, self.removed))
+            or any(visible(old) or visible(new) for old, new in self.renamed)
+            or any(visible(old) and visible(new) for old, new, _ in self.changed)
+            or any(old != "-" for _, _, old, _ in self.moved)
+        )
+
+    def report(self) -> str:
+        lines = []
+        interface = lambda cc: interface_of(cc, self.excluded_statuses)
+        for cc in self.added:
+            lines.append(f"+ {interface(cc):<6} {cc.func.signature} {cc.func.selector}")
+        for cc in self.removed:
+            lines.append(f"- {interface(cc):<6} {cc.func.signature} {cc.func.selector}")
+        for old, new in self.renamed:
+            lines.append(f"> {interface(new):<6} {old.func.id} renamed to {new.func.id} ({new.func.selector})")
+        for old, new, fields in self.changed:
+            lines.append(f"~ {interface(new):<6} {new.func.signature}: {', '.join(fields)} changed")
+            if "declaration" in fields:
+                lines.append(f"    - {old.func.declaration}")
+                lines.append(f"    + {new.func.declaration}")
+        for old, new, old_interface, new_interface in self.moved:
+            was = f"{old_interface} ({old.status}, {old.safety})"
+            lines.append(f"^ {new_interface:<6} {new.func.signature}: moved from {was}")
+        for name, (old_id, new_id) in self.interface_ids.items():
+            if old_id != new_id:
+                lines.append(f"{name} interfaceId 0x{old_id.hex()} -> 0x{new_id.hex()}")
+        if not lines:
+            return "No differences"
+        return "\n".join(lines)
+
+
+def write_vm(
+    f: "TextIO",
+    contract: "Cheatcodes",
+    safe: list["Cheatcode"],
+    unsafe: list["Cheatcode"],
+    digest: str,
+    printer_options: dict,
+    executor: "Executor | None" = None,
+    group_cache: "GroupCache | None" = None,
+    header: str = "",
+):
+    # `header` holds extra comment lines written after the input hash.
+    # With an executor, each group's functions are rendered by their own printer in parallel,
+    # and spliced into the interfaces in order. With a cache, only groups it has not rendered
+    # before are printed.
+    safe_functions = None
+    unsafe_functions = None
+    if executor is not None or group_cache is not None:
+        safe_chunks = group_chunks(safe)
+        all_chunks = safe_chunks + group_chunks(unsafe)
+        if group_cache is not None:
+            chunks = group_cache.render(all_chunks, printer_options)
+        else:
+            chunks = list(
+                executor.map(
+                    render_functions,
+                    all_chunks,
+                    itertools.repeat(printer_options),
+                    itertools.repeat(1),
+                )
+            )
+        safe_functions = chunks[: len(safe_chunks)]
+        unsafe_functions = chunks[len(safe_chunks) :]
+
+    f.write(GENERATED_HEADER)
+    f.write(f"{INPUT_HASH_PREFIX}{digest}\n")
+    f.write(header)
+    f.write("\n")
+
+    pp = CheatcodesPrinter(out=f, **printer_options)
     pp.p_prelude()
     pp.prelude = False
-    out += pp.finish()
+    pp.finish()
 
-    out += "\n\n"
-    out += VM_SAFE_DOC
+    f.write("\n\n")
+    f.write(VM_SAFE_DOC)
     vm_safe = Cheatcodes(
         # TODO: Custom errors were introduced in 0.8.4
         errors=[],  # contract.errors
@@ -65,11 +1156,11 @@ def main():
         structs=contract.structs,
         cheatcodes=safe,
     )
-    pp.p_contract(vm_safe, "VmSafe")
-    out += pp.finish()
+    pp.p_contract(vm_safe, "VmSafe", functions=safe_functions)
+    pp.finish()
 
-    out += "\n\n"
-    out += VM_DOC
+    f.write("\n\n")
+    f.write(VM_DOC)
     vm_unsafe = Cheatcodes(
         errors=[],
         events=[],
@@ -77,67 +1168,397 @@ def main():
         structs=[],
         cheatcodes=unsafe,
     )
-    pp.p_contract(vm_unsafe, "Vm", "VmSafe")
-    out += pp.finish()
-
-    # Compatibility with <0.8.0
-    def memory_to_calldata(m: re.Match) -> str:
-        return " calldata " + m.group(1)
-
-    out = re.sub(r" memory (.*returns)", memory_to_calldata, out)
-
-    with open(OUT_PATH, "w") as f:
-        f.write(out)
-
-    forge_fmt = ["forge", "fmt", OUT_PATH]
-    res = subprocess.run(forge_fmt)
-    assert res.returncode == 0, f"command failed: {forge_fmt}"
-
-    print(f"Wrote to {OUT_PATH}")
-
-
-class CmpCheatcode:
-    cheatcode: "Cheatcode"
-
-    def __init__(self, cheatcode: "Cheatcode"):
-        self.cheatcode = cheatcode
-
-    def __lt__(self, other: "CmpCheatcode") -> bool:
-        return cmp_cheatcode(self.cheatcode, other.cheatcode) < 0
-
-    def __eq__(self, other: "CmpCheatcode") -> bool:
-        return cmp_cheatcode(self.cheatcode, other.cheatcode) == 0
-
-    def __gt__(self, other: "CmpCheatcode") -> bool:
-        return cmp_cheatcode(self.cheatcode, other.cheatcode) > 0
+    pp.p_contract(vm_unsafe, "Vm", "VmSafe", functions=unsafe_functions)
+    pp.finish()
+    f.write(pp.nl_str)
+
+
+# Splits sorted cheatcodes into runs of the same group.
+def group_chunks(cheatcodes: list["Cheatcode"]) -> list[list["Cheatcode"]]:
+    chunks = []
+    for cc in cheatcodes:
+        if not chunks or chunks[-1][-1].group != cc.group:
+            chunks.append([])
+        chunks[-1].append(cc)
+    return chunks
+
+
+def render_functions(cheatcodes: list["Cheatcode"], printer_options: dict, indent_level: int) -> str:
+    pp = CheatcodesPrinter(indent_level=indent_level, **printer_options)
+    pp.p_functions(cheatcodes)
+    return pp.buffer
+
+
+# Groups of functions rendered by `render_functions`, keyed by what their output depends on.
+class GroupCache:
+    printer_options: dict | None
+    _rendered: dict[tuple, str]
+    # How many groups the last `render` had to print.
+    misses: int
+
+    def __init__(self):
+        self.printer_options = None
+        self._rendered = {}
+        self.misses = 0
+
+    # Renders each chunk, reusing what the previous call rendered. Anything not reused is dropped.
+    def render(self, chunks: list[list["Cheatcode"]], printer_options: dict) -> list[str]:
+        if printer_options != self.printer_options:
+            self.printer_options = dict(printer_options)
+            self._rendered = {}
+        rendered = {}
+        ret = []
+        self.misses = 0
+        for chunk in chunks:
+            key = tuple((cc.group, cc.func.description, cc.func.declaration) for cc in chunk)
+            text = self._rendered.get(key)
+            if text is None:
+                text = render_functions(chunk, printer_options, 1)
+                self.misses += 1
+            rendered[key] = text
+            ret.append(text)
+        self._rendered = rendered
+        return ret
 
 
-def cmp_cheatcode(a: "Cheatcode", b: "Cheatcode") -> int:
-    if a.group != b.group:
-        return -1 if a.group < b.group else 1
-    if a.status != b.status:
-        return -1 if a.status < b.status else 1
-    if a.safety != b.safety:
-        return -1 if a.safety < b.safety else 1
-    if a.func.id != b.func.id:
-        return -1 if a.func.id < b.func.id else 1
-    return 0
+# The cheatcodes of the spec `watch` saw last, each with the entry it was parsed from.
+class ResidentModel:
+    _parsed: dict[str, tuple[dict, "Cheatcode"]]
+    # How many cheatcodes the last `update` had to parse.
+    misses: int
+
+    def __init__(self):
+        self._parsed = {}
+        self.misses = 0
+
+    # Builds the model of `spec`, reusing each cheatcode whose entry is unchanged since the previous
+    # call. The selectors of the others are verified against `selector_cache` as in
+    # `verify_selectors`, unless it is None; if they are wrong, nothing is kept.
+    def update(self, spec: bytes, selector_cache: str | None = None) -> "Cheatcodes":
+        d = json.loads(spec)
+        parsed = {}
+        cheatcodes = []
+        new = []
+        for entry in d["cheatcodes"]:
+            id = entry["func"]["id"]
+            prev = self._parsed.get(id)
+            if prev is not None and prev[0] == entry:
+                cc = prev[1]
+            else:
+                cc = Cheatcode.from_dict(entry)
+                new.append(cc)
+            parsed[id] = (entry, cc)
+            cheatcodes.append(cc)
+        if new and selector_cache is not None:
+            verify_selectors(new, selector_cache)
+        self._parsed = parsed
+        self.misses = len(new)
+        sections = ["errors", "events", "enums", "structs"]
+        return Cheatcodes(None, None, None, None, cheatcodes, raw={k: d[k] for k in sections})
+
+
+# Writes `path` through a temp file in the same directory that is renamed over it once the
+# block completes, so that readers such as a concurrent `forge build` see either the old or the
+# new contents, never a truncated file. With `fsync`, the data and the rename are flushed to disk.
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w", fsync: bool = False):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        try:
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+# The printer emits what `forge fmt` would, given the `[fmt]` settings from foundry.toml. It
+# implements `line_length` and the indentation, and for the other settings that can change the
+# generated files only the values listed here; anything else is rejected rather than printed
+# differently from `forge fmt`.
+FMT_SUPPORTED_VALUES = {
+    "bracket_spacing": [False],
+    "contract_new_lines": [False],
+    "int_types": ["long", "preserve"],
+    "multiline_func_header": ["attributes_first"],
+    "quote_style": ["double"],
+    "style": ["space", "tab"],
+    "wrap_comments": [False],
+}
+# Settings with no effect on the generated files.
+FMT_IGNORED = {
+    "hex_underscore",
+    "ignore",
+    "number_underscore",
+    "override_spacing",
+    "single_line_statement_blocks",
+    "sort_imports",
+}
+
+
+def fmt_options(foundry_toml: str) -> dict:
+    try:
+        with open(foundry_toml, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        # `forge fmt` uses its defaults too.
+        data = b""
+    try:
+        import tomllib
+    except ImportError:
+        try:
+            import tomli as tomllib
+        except ImportError:
+            assert data == b"", f"reading {foundry_toml} needs Python 3.11 or later, or tomli installed"
+    config = tomllib.loads(data.decode("utf-8")) if data else {}
+
+    profiles = [name for name, profile in config.get("profile", {}).items() if "fmt" in profile]
+    assert not profiles, f"{foundry_toml}: [fmt] settings in profiles ({', '.join(profiles)}) are not supported"
+    fmt = config.get("fmt", {})
+    for key, value in fmt.items():
+        if key in ("line_length", "tab_width", "use_tabs") or key in FMT_IGNORED:
+            continue
+        assert key in FMT_SUPPORTED_VALUES, f"{foundry_toml}: unsupported [fmt] setting {key}"
+        supported = FMT_SUPPORTED_VALUES[key]
+        assert value in supported, f"{foundry_toml}: [fmt] {key} = {value!r} is not supported, only {supported}"
+
+    use_tabs = fmt.get("use_tabs", False) or fmt.get("style") == "tab"
+    return dict(
+        line_length=fmt.get("line_length", 120),
+        indent_with="\t" if use_tabs else fmt.get("tab_width", 4),
+    )
 
 
-# HACK: A way to add group header comments without having to modify printer code
-def prefix_with_group_headers(cheats: list["Cheatcode"]):
-    s = set()
-    for i, cheat in enumerate(cheats):
-        if cheat.group in s:
+def strip_input_hash(s: str) -> str:
+    return "".join(line for line in s.splitlines(keepends=True) if not line.startswith(INPUT_HASH_PREFIX))
+
+
+# Hash of everything the generated files are derived from: the raw spec, the status filter, the
+# printer options, whether the output is split, and this script itself, so that changes to the
+# generator also invalidate them. It is computed before the spec is parsed.
+def input_hash(spec: bytes, status_filter: str, printer_options: dict, split: bool) -> str:
+    import hashlib
+
+    h = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps([status_filter, printer_options, split], sort_keys=True).encode("utf-8"))
+    h.update(b"\0")
+    h.update(spec)
+    return h.hexdigest()
+
+
+# The `input_hash` of `spec` for the forge-std checkout at `root`.
+def target_digest(spec: bytes, root: str, status_filter: str, split: bool = False) -> str:
+    return input_hash(spec, status_filter, vm_printer_options(root), split)
+
+
+# Whether `OUT_PATH` under `root` was generated from inputs hashing to `digest`, and the split
+# files it lists, if any, are still what was generated.
+def is_up_to_date(root: str, digest: str) -> bool:
+    out_path = os.path.join(root, OUT_PATH)
+    if read_input_hash(out_path) != digest:
+        return False
+    import hashlib
+
+    with open(out_path, "r") as f:
+        for line in f:
+            if not line.startswith("//"):
+                break
+            if not line.startswith(SPLIT_FILE_PREFIX):
+                continue
+            path, sha256 = line[len(SPLIT_FILE_PREFIX) :].split()
+            try:
+                with open(os.path.join(root, path), "rb") as split_file:
+                    if hashlib.sha256(split_file.read()).hexdigest() != sha256:
+                        return False
+            except FileNotFoundError:
+                return False
+    return True
+
+
+def read_input_hash(path: str) -> str | None:
+    try:
+        with open(path, "r") as f:
+            if f.readline() != GENERATED_HEADER:
+                return None
+            line = f.readline()
+    except FileNotFoundError:
+        return None
+    if not line.startswith(INPUT_HASH_PREFIX):
+        return None
+    return line[len(INPUT_HASH_PREFIX) :].strip()
+
+
+# Downloaded specs, stored by the SHA-256 of their contents. `index.json` maps each URL to
+# the hash of its last download and the `ETag`/`Last-Modified` validators it was served with,
+# which are sent back on the next download so an unchanged spec only costs a `304`.
+class SpecCache:
+    dir: str
+
+    def __init__(self, dir: str):
+        self.dir = dir
+
+    def fetch(self, url: str, offline: bool = False) -> str:
+        import hashlib
+        from urllib import error, request
+
+        entry = self._index().get(url)
+        if entry is not None and not os.path.exists(self._blob_path(entry["sha256"])):
+            entry = None
+
+        if offline:
+            assert entry is not None, f"--offline: no cached spec for {url} in {self.dir}"
+            return self._read_blob(entry["sha256"])
+
+        req = request.Request(url)
+        if entry is not None:
+            if entry.get("etag"):
+                req.add_header("If-None-Match", entry["etag"])
+            if entry.get("last_modified"):
+                req.add_header("If-Modified-Since", entry["last_modified"])
+
+        try:
+            with request.urlopen(req) as res:
+                data = res.read()
+                headers = res.headers
+        except error.URLError as e:
+            # An `HTTPError` is a `URLError` too, and holds the response open. A 304 means the
+            # cached spec is current; any other failure to download falls back to it with a warning.
+            if isinstance(e, error.HTTPError):
+                e.close()
+            if entry is None:
+                raise
+            if isinstance(e, error.HTTPError) and e.code == 304:
+                return self._read_blob(entry["sha256"])
+            reason = e if isinstance(e, error.HTTPError) else e.reason
+            print(f"warning: could not download {url} ({reason}), using cached spec", file=sys.stderr)
+            return self._read_blob(entry["sha256"])
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self._blob_path(sha256)):
+            os.makedirs(self.dir, exist_ok=True)
+            with atomic_write(self._blob_path(sha256), "wb") as f:
+                f.write(data)
+        self._update_index(
+            url,
+            {
+                "sha256": sha256,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+            },
+        )
+        return data.decode("utf-8")
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.dir, f"{sha256}.json")
+
+    def _read_blob(self, sha256: str) -> str:
+        import hashlib
+
+        with open(self._blob_path(sha256), "rb") as f:
+            data = f.read()
+        assert hashlib.sha256(data).hexdigest() == sha256, f"corrupted cache entry {self._blob_path(sha256)}"
+        return data.decode("utf-8")
+
+    def _index_path(self) -> str:
+        return os.path.join(self.dir, "index.json")
+
+    def _index(self) -> dict:
+        try:
+            with open(self._index_path(), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _update_index(self, url: str, entry: dict):
+        index = self._index()
+        index[url] = entry
+        os.makedirs(self.dir, exist_ok=True)
+        with atomic_write(self._index_path()) as f:
+            json.dump(index, f, indent=2)
+
+
+# Parsed specs, pickled with every section materialized and the cheatcodes sorted by
+# `cheatcode_sort_key`, which makes sorting each target's partitions nearly free. Entries are
+# keyed by the spec, the source of this script and the name it was imported under, since the
+# pickles refer to the classes by module: `__main__` when run as a script, `vm` when imported.
+class ModelCache:
+    dir: str
+
+    def __init__(self, dir: str):
+        self.dir = dir
+
+    def load(self, spec: bytes) -> "Cheatcodes":
+        import pickle
+
+        path = self._path(spec)
+        try:
+            with open(path, "rb") as f:
+                contract = pickle.load(f)
+            assert isinstance(contract, Cheatcodes), f"unpickled a {type(contract).__name__}"
+            return contract
+        except FileNotFoundError:
+            pass
+        except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, AssertionError) as e:
+            print(f"warning: ignoring corrupted parsed spec {path} ({e})", file=sys.stderr)
+
+        contract = Cheatcodes.from_json(spec).materialize()
+        contract.cheatcodes.sort(key=cheatcode_sort_key)
+
+        os.makedirs(self.dir, exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            pickle.dump(contract, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return contract
+
+    def _path(self, spec: bytes) -> str:
+        import hashlib
+
+        h = hashlib.sha256()
+        with open(__file__, "rb") as f:
+            h.update(f.read())
+        h.update(__name__.encode("utf-8") + b"\0")
+        h.update(spec)
+        return os.path.join(self.dir, f"{h.hexdigest()}.pickle")
+
+
+# Drops cheatcodes whose status is in `excluded_statuses` and splits the rest into `VmSafe`
+# and `Vm` cheatcodes, each sorted by `cheatcode_sort_key`.
+def partition_cheatcodes(
+    cheatcodes: list["Cheatcode"],
+    excluded_statuses: tuple[str, ...] = STATUS_FILTERS["default"],
+) -> tuple[list["Cheatcode"], list["Cheatcode"]]:
+    safe = []
+    unsafe = []
+    for cc in cheatcodes:
+        if cc.status in excluded_statuses:
             continue
+        if cc.safety == "safe":
+            safe.append(cc)
+        else:
+            assert cc.safety == "unsafe", f"unknown safety {cc.safety!r} for {cc.func.id}"
+            unsafe.append(cc)
+    safe.sort(key=cheatcode_sort_key)
+    unsafe.sort(key=cheatcode_sort_key)
+    return safe, unsafe
 
-        s.add(cheat.group)
 
-        c = copy.deepcopy(cheat)
-        c.func.description = ""
-        c.func.declaration = f"// ======== {group(c.group)} ========"
-        cheats.insert(i, c)
-    return cheats
+def cheatcode_sort_key(cc: "Cheatcode") -> tuple[str, str, str, str]:
+    return (cc.group, cc.status, cc.safety, cc.func.id)
 
 
 def group(s: str) -> str:
@@ -148,6 +1569,73 @@ def group(s: str) -> str:
     return s[0].upper() + s[1:]
 
 
+# Splits `function f(uint256 a, bytes b) external returns (bytes c);` into
+# `("function f", "uint256 a, bytes b", ["external", "returns (bytes c)"])`.
+def split_declaration(decl: str) -> tuple[str, str, list[str]]:
+    decl = decl.strip().removesuffix(";")
+    open_idx = decl.index("(")
+    close_idx = matching_paren(decl, open_idx)
+    head = decl[:open_idx]
+    params = decl[open_idx + 1 : close_idx]
+
+    attrs = []
+    rest = decl[close_idx + 1 :].strip()
+    while rest != "":
+        if rest.startswith("returns"):
+            open_idx = rest.index("(")
+            close_idx = matching_paren(rest, open_idx)
+            attrs.append("returns " + rest[open_idx : close_idx + 1])
+            rest = rest[close_idx + 1 :].strip()
+        else:
+            attr, _, rest = rest.partition(" ")
+            attrs.append(attr)
+            rest = rest.strip()
+    return head, params, attrs
+
+
+# Compatibility with <0.8.0: makes the first `memory` parameter of a function that returns
+# something `calldata`, which is what the ` memory (.*returns)` regex previously run over the
+# whole output did to declarations, without touching anything but the parameter list.
+def memory_to_calldata(decl: str) -> str:
+    open_idx = decl.index("(")
+    close_idx = matching_paren(decl, open_idx)
+    if "returns" not in decl[close_idx:]:
+        return decl
+    i = decl.find(" memory ", open_idx, close_idx)
+    if i == -1:
+        return decl
+    return decl[:i] + " calldata " + decl[i + len(" memory ") :]
+
+
+def split_params(params: str) -> list[str]:
+    ret = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(params):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            ret.append(params[start:i].strip())
+            start = i + 1
+    if params[start:].strip() != "":
+        ret.append(params[start:].strip())
+    return ret
+
+
+def matching_paren(s: str, open_idx: int) -> int:
+    depth = 0
+    for i in range(open_idx, len(s)):
+        if s[i] == "(":
+            depth += 1
+        elif s[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+    assert False, f"unbalanced parentheses in {s}"
+
+
 class Visibility(PyEnum):
     EXTERNAL: str = "external"
     PUBLIC: str = "public"
@@ -167,14 +1655,17 @@ class Mutability(PyEnum):
         return self.value
 
 
+# The spec model classes are slotted, and their strings are interned when parsed, so that
+# many specs can be held in memory at once: consecutive Foundry releases share most strings.
 class Function:
+    __slots__ = ("id", "description", "declaration", "visibility", "mutability", "signature", "selector_bytes")
+
     id: str
     description: str
     declaration: str
     visibility: Visibility
     mutability: Mutability
     signature: str
-    selector: str
     selector_bytes: bytes
 
     def __init__(
@@ -194,24 +1685,45 @@ class Function:
         self.visibility = visibility
         self.mutability = mutability
         self.signature = signature
-        self.selector = selector
         self.selector_bytes = selector_bytes
+        assert selector == self.selector, f"{id}: selector {selector} does not match selectorBytes {self.selector}"
+
+    # Derived from `selector_bytes` rather than stored twice.
+    @property
+    def selector(self) -> str:
+        return "0x" + self.selector_bytes.hex()
+
+    # Pickled as constructor arguments, which `ModelCache` loads faster than the slots' state.
+    def __reduce__(self):
+        args = (
+            self.id,
+            self.description,
+            self.declaration,
+            self.visibility,
+            self.mutability,
+            self.signature,
+            self.selector,
+            self.selector_bytes,
+        )
+        return (Function, args)
 
     @staticmethod
     def from_dict(d: dict) -> "Function":
         return Function(
-            d["id"],
-            d["description"],
-            d["declaration"],
+            intern(d["id"]),
+            intern(d["description"]),
+            intern(d["declaration"]),
             Visibility(d["visibility"]),
             Mutability(d["mutability"]),
-            d["signature"],
+            intern(d["signature"]),
             d["selector"],
             bytes(d["selectorBytes"]),
         )
 
 
 class Cheatcode:
+    __slots__ = ("func", "group", "status", "safety")
+
     func: Function
     group: str
     status: str
@@ -223,17 +1735,22 @@ class Cheatcode:
         self.status = status
         self.safety = safety
 
+    def __reduce__(self):
+        return (Cheatcode, (self.func, self.group, self.status, self.safety))
+
     @staticmethod
     def from_dict(d: dict) -> "Cheatcode":
         return Cheatcode(
             Function.from_dict(d["func"]),
-            str(d["group"]),
-            str(d["status"]),
-            str(d["safety"]),
+            intern(str(d["group"])),
+            intern(str(d["status"])),
+            intern(str(d["safety"])),
         )
 
 
 class Error:
+    __slots__ = ("name", "description", "declaration")
+
     name: str
     description: str
     declaration: str
@@ -245,10 +1762,12 @@ class Error:
 
     @staticmethod
     def from_dict(d: dict) -> "Error":
-        return Error(**d)
+        return Error(intern(d["name"]), intern(d["description"]), intern(d["declaration"]))
 
 
 class Event:
+    __slots__ = ("name", "description", "declaration")
+
     name: str
     description: str
     declaration: str
@@ -260,10 +1779,12 @@ class Event:
 
     @staticmethod
     def from_dict(d: dict) -> "Event":
-        return Event(**d)
+        return Event(intern(d["name"]), intern(d["description"]), intern(d["declaration"]))
 
 
 class EnumVariant:
+    __slots__ = ("name", "description")
+
     name: str
     description: str
 
@@ -273,6 +1794,8 @@ class EnumVariant:
 
 
 class Enum:
+    __slots__ = ("name", "description", "variants")
+
     name: str
     description: str
     variants: list[EnumVariant]
@@ -285,13 +1808,15 @@ class Enum:
     @staticmethod
     def from_dict(d: dict) -> "Enum":
         return Enum(
-            d["name"],
-            d["description"],
-            list(map(lambda v: EnumVariant(**v), d["variants"])),
+            intern(d["name"]),
+            intern(d["description"]),
+            [EnumVariant(intern(v["name"]), intern(v["description"])) for v in d["variants"]],
         )
 
 
 class StructField:
+    __slots__ = ("name", "ty", "description")
+
     name: str
     ty: str
     description: str
@@ -303,6 +1828,8 @@ class StructField:
 
 
 class Struct:
+    __slots__ = ("name", "description", "fields")
+
     name: str
     description: str
     fields: list[StructField]
@@ -315,13 +1842,20 @@ class Struct:
     @staticmethod
     def from_dict(d: dict) -> "Struct":
         return Struct(
-            d["name"],
-            d["description"],
-            list(map(lambda f: StructField(**f), d["fields"])),
+            intern(d["name"]),
+            intern(d["description"]),
+            [StructField(intern(f["name"]), intern(f["ty"]), intern(f["description"])) for f in d["fields"]],
         )
 
 
+# Sections of a spec loaded with `from_dict` are only parsed the first time they are accessed,
+# so that e.g. the errors, which `Vm.sol` leaves out, are never materialized.
 class Cheatcodes:
+    __slots__ = ("_raw", "_errors", "_events", "_enums", "_structs", "_cheatcodes")
+
+    # Sections not parsed yet, by key. Each is removed from here once it is parsed.
+    _raw: dict
+
     errors: list[Error]
     events: list[Event]
     enums: list[Enum]
@@ -330,27 +1864,60 @@ class Cheatcodes:
 
     def __init__(
         self,
-        errors: list[Error],
-        events: list[Event],
-        enums: list[Enum],
-        structs: list[Struct],
-        cheatcodes: list[Cheatcode],
+        errors: list[Error] | None,
+        events: list[Event] | None,
+        enums: list[Enum] | None,
+        structs: list[Struct] | None,
+        cheatcodes: list[Cheatcode] | None,
+        raw: dict | None = None,
     ):
-        self.errors = errors
-        self.events = events
-        self.enums = enums
-        self.structs = structs
-        self.cheatcodes = cheatcodes
+        self._raw = raw or {}
+        self._errors = errors
+        self._events = events
+        self._enums = enums
+        self._structs = structs
+        self._cheatcodes = cheatcodes
+
+    @property
+    def errors(self) -> list[Error]:
+        if self._errors is None:
+            self._errors = [Error.from_dict(e) for e in self._raw.pop("errors")]
+        return self._errors
+
+    @property
+    def events(self) -> list[Event]:
+        if self._events is None:
+            self._events = [Event.from_dict(e) for e in self._raw.pop("events")]
+        return self._events
+
+    @property
+    def enums(self) -> list[Enum]:
+        if self._enums is None:
+            self._enums = [Enum.from_dict(e) for e in self._raw.pop("enums")]
+        return self._enums
+
+    @property
+    def structs(self) -> list[Struct]:
+        if self._structs is None:
+            self._structs = [Struct.from_dict(e) for e in self._raw.pop("structs")]
+        return self._structs
+
+    @property
+    def cheatcodes(self) -> list[Cheatcode]:
+        if self._cheatcodes is None:
+            self._cheatcodes = [Cheatcode.from_dict(e) for e in self._raw.pop("cheatcodes")]
+        return self._cheatcodes
+
+    # Parses every section not parsed yet, e.g. before the model is pickled or handed to other
+    # processes, and returns `self`.
+    def materialize(self) -> "Cheatcodes":
+        self.errors, self.events, self.enums, self.structs, self.cheatcodes
+        return self
 
     @staticmethod
     def from_dict(d: dict) -> "Cheatcodes":
-        return Cheatcodes(
-            errors=[Error.from_dict(e) for e in d["errors"]],
-            events=[Event.from_dict(e) for e in d["events"]],
-            enums=[Enum.from_dict(e) for e in d["enums"]],
-            structs=[Struct.from_dict(e) for e in d["structs"]],
-            cheatcodes=[Cheatcode.from_dict(e) for e in d["cheatcodes"]],
-        )
+        sections = ["errors", "events", "enums", "structs", "cheatcodes"]
+        return Cheatcodes(None, None, None, None, None, raw={k: d[k] for k in sections})
 
     @staticmethod
     def from_json(s) -> "Cheatcodes":
@@ -396,7 +1963,18 @@ class ItemOrder:
 
 
 class CheatcodesPrinter:
-    buffer: str
+    # Chunks of the declaration currently being printed.
+    _chunks: list[str]
+    # Where flushed declarations go: `out` if set, `_flushed` otherwise.
+    out: "TextIO | None"
+    _flushed: list[str]
+    # Trailing whitespace held back until something else is flushed, so that
+    # `finish` can drop it without re-reading what was already written.
+    _pending_ws: str
+
+    memory_to_calldata: bool
+    line_length: int
+    group_headers: bool
 
     prelude: bool
     spdx_identifier: str
@@ -407,6 +1985,8 @@ class CheatcodesPrinter:
 
     indent_level: int
     _indent_str: str
+    # `_indent_str * level`, built once per level.
+    _indents: list[str]
 
     nl_str: str
 
@@ -423,14 +2003,24 @@ class CheatcodesPrinter:
         indent_level: int = 0,
         indent_with: int | str = 4,
         nl_str: str = "\n",
-        items_order: ItemOrder = ItemOrder.default(),
+        items_order: ItemOrder | None = None,
+        out: "TextIO | None" = None,
+        memory_to_calldata: bool = False,
+        line_length: int = 0,
+        group_headers: bool = False,
     ):
         self.prelude = prelude
         self.spdx_identifier = spdx_identifier
         self.solidity_requirement = solidity_requirement
         self.abicoder_v2 = abicoder_pragma
         self.block_doc_style = block_doc_style
-        self.buffer = buffer
+        self._chunks = [buffer] if buffer else []
+        self.out = out
+        self._flushed = []
+        self._pending_ws = ""
+        self.memory_to_calldata = memory_to_calldata
+        self.line_length = line_length
+        self.group_headers = group_headers
         self.indent_level = indent_level
         self.nl_str = nl_str
 
@@ -441,15 +2031,57 @@ class CheatcodesPrinter:
             self._indent_str = indent_with
         else:
             assert False, "indent_with must be int or str"
+        self._indents = [""]
 
-        self.items_order = items_order
+        self.items_order = items_order or ItemOrder.default()
 
+    @property
+    def buffer(self) -> str:
+        return "".join(self._flushed) + self._pending_ws + "".join(self._chunks)
+
+    # Returns everything printed since the last call, without trailing whitespace.
+    # When printing to `out` the text has already been written there and "" is returned.
     def finish(self) -> str:
-        ret = self.buffer.rstrip()
-        self.buffer = ""
+        self._flush()
+        self._pending_ws = ""
+        ret = "".join(self._flushed)
+        self._flushed = []
         return ret
 
-    def p_contract(self, contract: Cheatcodes, name: str, inherits: str = ""):
+    def _flush(self):
+        txt = "".join(self._chunks)
+        self._chunks = []
+        stripped = txt.rstrip()
+        if stripped == "":
+            self._pending_ws += txt
+            return
+        self._write(self._pending_ws)
+        self._write(stripped)
+        self._pending_ws = txt[len(stripped) :]
+
+    # Drops the blank line that separates the last item from whatever follows it.
+    def _trim_blank_lines(self):
+        self._flush()
+        if self._pending_ws != "":
+            self._pending_ws = self.nl_str
+
+    def _write(self, txt: str):
+        if txt == "":
+            return
+        if self.out is not None:
+            self.out.write(txt)
+        else:
+            self._flushed.append(txt)
+
+    # `functions`, if given, are pre-rendered function chunks (see `render_functions`) that are
+    # printed in place of `contract.cheatcodes`.
+    def p_contract(
+        self,
+        contract: Cheatcodes,
+        name: str,
+        inherits: str = "",
+        functions: list[str] | None = None,
+    ):
         if self.prelude:
             self.p_prelude(contract)
 
@@ -458,17 +2090,38 @@ class CheatcodesPrinter:
         if name != "":
             self._p_str(name)
             self._p_str(" ")
+        empty = not any(
+            [contract.errors, contract.events, contract.enums, contract.structs, contract.cheatcodes, functions]
+        )
         if inherits != "":
-            self._p_str("is ")
-            self._p_str(inherits)
-            self._p_str(" ")
+            # Like `forge fmt`, put each base on its own line if the header is too long.
+            header = f"interface {name} is {inherits} {{"
+            if self.line_length == 0 or len(header) <= self.line_length:
+                self._p_str("is ")
+                self._p_str(inherits)
+                self._p_str(" ")
+            else:
+                self._p_str("is")
+                self._p_nl()
+                bases = [b.strip() for b in inherits.split(",")]
+                for i, base in enumerate(bases):
+                    end = "," if i < len(bases) - 1 else ""
+                    self._p_str(f"{self._indent_str}{base}{end}")
+                    self._p_nl()
+        if empty:
+            self._p_str("{}")
+            self._p_nl()
+            return
         self._p_str("{")
         self._p_nl()
-        self._with_indent(lambda: self._p_items(contract))
+        self.indent_level += 1
+        self._p_items(contract, functions)
+        self.indent_level -= 1
+        self._trim_blank_lines()
         self._p_str("}")
         self._p_nl()
 
-    def _p_items(self, contract: Cheatcodes):
+    def _p_items(self, contract: Cheatcodes, functions: list[str] | None = None):
         for item in self.items_order.get_list():
             if item == Item.ERROR:
                 self.p_errors(contract.errors)
@@ -478,11 +2131,19 @@ class CheatcodesPrinter:
                 self.p_enums(contract.enums)
             elif item == Item.STRUCT:
                 self.p_structs(contract.structs)
+            elif item == Item.FUNCTION and functions is not None:
+                for chunk in functions:
+                    self._p_str(chunk)
+                    self._flush()
             elif item == Item.FUNCTION:
                 self.p_functions(contract.cheatcodes)
             else:
                 assert False, f"unknown item {item}"
 
+    def p_import(self, names: list[str], path: str):
+        self._p_str(f'import {{{", ".join(names)}}} from "{path}";')
+        self._p_nl()
+
     def p_prelude(self, contract: Cheatcodes | None = None):
         self._p_str(f"// SPDX-License-Identifier: {self.spdx_identifier}")
         self._p_nl()
@@ -504,131 +2165,273 @@ class CheatcodesPrinter:
 
     def p_errors(self, errors: list[Error]):
         for error in errors:
-            self._p_line(lambda: self.p_error(error))
+            self.p_error(error)
+            self._p_nl()
+            self._flush()
 
     def p_error(self, error: Error):
         self._p_comment(error.description, doc=True)
-        self._p_line(lambda: self._p_str(error.declaration))
+        self._p_declaration(error.declaration)
 
     def p_events(self, events: list[Event]):
         for event in events:
-            self._p_line(lambda: self.p_event(event))
+            self.p_event(event)
+            self._p_nl()
+            self._flush()
 
     def p_event(self, event: Event):
         self._p_comment(event.description, doc=True)
-        self._p_line(lambda: self._p_str(event.declaration))
+        self._p_declaration(event.declaration)
 
     def p_enums(self, enums: list[Enum]):
         for enum in enums:
-            self._p_line(lambda: self.p_enum(enum))
+            self.p_enum(enum)
+            self._p_nl()
+            self._flush()
 
     def p_enum(self, enum: Enum):
         self._p_comment(enum.description, doc=True)
-        self._p_line(lambda: self._p_str(f"enum {enum.name} {{"))
-        self._with_indent(lambda: self.p_enum_variants(enum.variants))
-        self._p_line(lambda: self._p_str("}"))
+        self._p_line(f"enum {enum.name} {{")
+        self.indent_level += 1
+        self.p_enum_variants(enum.variants)
+        self.indent_level -= 1
+        self._p_line("}")
 
     def p_enum_variants(self, variants: list[EnumVariant]):
         for i, variant in enumerate(variants):
-            self._p_indent()
             self._p_comment(variant.description)
-
-            self._p_indent()
-            self._p_str(variant.name)
-            if i < len(variants) - 1:
-                self._p_str(",")
-            self._p_nl()
+            end = "," if i < len(variants) - 1 else ""
+            self._p_line(f"{variant.name}{end}")
 
     def p_structs(self, structs: list[Struct]):
         for struct in structs:
-            self._p_line(lambda: self.p_struct(struct))
+            self.p_struct(struct)
+            self._p_nl()
+            self._flush()
 
     def p_struct(self, struct: Struct):
         self._p_comment(struct.description, doc=True)
-        self._p_line(lambda: self._p_str(f"struct {struct.name} {{"))
-        self._with_indent(lambda: self.p_struct_fields(struct.fields))
-        self._p_line(lambda: self._p_str("}"))
+        self._p_line(f"struct {struct.name} {{")
+        self.indent_level += 1
+        self.p_struct_fields(struct.fields)
+        self.indent_level -= 1
+        self._p_line("}")
 
     def p_struct_fields(self, fields: list[StructField]):
         for field in fields:
-            self._p_line(lambda: self.p_struct_field(field))
+            self.p_struct_field(field)
 
     def p_struct_field(self, field: StructField):
         self._p_comment(field.description)
-        self._p_indented(lambda: self._p_str(f"{field.ty} {field.name};"))
+        self._p_line(f"{field.ty} {field.name};")
+
+    # Prints a function, error or event declaration, wrapped the way `forge fmt` does with
+    # `multiline_func_header = "attributes_first"` if it does not fit in `line_length`.
+    def _p_declaration(self, decl: str):
+        indent = self._indent()
+        nl = self.nl_str
+        # `forge fmt` keeps room for a trailing ` {` even on declarations without a body.
+        if self.line_length == 0 or len(indent) + len(decl) + 2 <= self.line_length:
+            self._chunks.append(f"{indent}{decl}{nl}")
+            return
 
+        head, params, attrs = split_declaration(decl)
+        inner = indent + self._indent_str
+        if len(indent) + len(head) + len(params) + 2 <= self.line_length:
+            last = len(attrs) - 1
+            lines = [f"{indent}{head}({params}){nl}"]
+            lines += [f"{inner}{attr}{';' if i == last else ''}{nl}" for i, attr in enumerate(attrs)]
+            self._chunks.append("".join(lines))
+            return
+
+        params = split_params(params)
+        lines = [f"{indent}{head}({nl}"]
+        last = len(params) - 1
+        lines += [f"{inner}{param}{',' if i < last else ''}{nl}" for i, param in enumerate(params)]
+        lines.append(f"{indent}{' '.join([')'] + attrs)};{nl}")
+        self._chunks.append("".join(lines))
+
+    # `cheatcodes` must be sorted by group for each group to get a single header.
     def p_functions(self, cheatcodes: list[Cheatcode]):
+        last_group = None
         for cheatcode in cheatcodes:
-            self._p_line(lambda: self.p_function(cheatcode.func))
+            if self.group_headers and cheatcode.group != last_group:
+                self.p_group_header(cheatcode.group)
+                self._p_nl()
+                last_group = cheatcode.group
+            self.p_function(cheatcode.func)
+            self._p_nl()
+            self._flush()
+
+    def p_group_header(self, name: str):
+        self._p_line(f"// ======== {group(name)} ========")
 
     def p_function(self, func: Function):
         self._p_comment(func.description, doc=True)
-        self._p_line(lambda: self._p_str(func.declaration))
+        decl = func.declaration
+        if self.memory_to_calldata:
+            decl = memory_to_calldata(decl)
+        self._p_declaration(decl)
 
     def _p_comment(self, s: str, doc: bool = False):
         s = s.strip()
         if s == "":
             return
 
-        s = map(lambda line: line.lstrip(), s.split("\n"))
+        indent = self._indent()
+        nl = self.nl_str
         if self.block_doc_style:
-            self._p_str("/*")
-            if doc:
-                self._p_str("*")
-            self._p_nl()
-            for line in s:
-                self._p_indent()
-                self._p_str(" ")
-                if doc:
-                    self._p_str("* ")
-                self._p_str(line)
-                self._p_nl()
-            self._p_indent()
-            self._p_str(" */")
-            self._p_nl()
+            prefix = f"{indent} * " if doc else f"{indent} "
+            lines = [f"{indent}/**{nl}" if doc else f"{indent}/*{nl}"]
+            lines += [f"{prefix}{line.lstrip()}{nl}" for line in s.split("\n")]
+            lines.append(f"{indent} */{nl}")
         else:
-            first_line = True
-            for line in s:
-                if not first_line:
-                    self._p_indent()
-                first_line = False
-
-                if doc:
-                    self._p_str("/// ")
-                else:
-                    self._p_str("// ")
-                self._p_str(line)
-                self._p_nl()
-
-    def _with_indent(self, f: VoidFn):
-        self._inc_indent()
-        f()
-        self._dec_indent()
-
-    def _p_line(self, f: VoidFn):
-        self._p_indent()
-        f()
-        self._p_nl()
+            prefix = f"{indent}/// " if doc else f"{indent}// "
+            lines = [f"{prefix}{line.lstrip()}{nl}" for line in s.split("\n")]
+        self._chunks.append("".join(lines))
 
-    def _p_indented(self, f: VoidFn):
-        self._p_indent()
-        f()
+    def _indent(self) -> str:
+        level = self.indent_level
+        while len(self._indents) <= level:
+            self._indents.append(self._indent_str * len(self._indents))
+        return self._indents[level]
 
-    def _p_indent(self):
-        for _ in range(self.indent_level):
-            self._p_str(self._indent_str)
+    # Prints `txt` as a whole line at the current indentation.
+    def _p_line(self, txt: str):
+        self._chunks.append(f"{self._indent()}{txt}{self.nl_str}")
 
     def _p_nl(self):
         self._p_str(self.nl_str)
 
     def _p_str(self, txt: str):
-        self.buffer += txt
+        self._chunks.append(txt)
 
-    def _inc_indent(self):
-        self.indent_level += 1
 
-    def _dec_indent(self):
-        self.indent_level -= 1
+# Backends that emit something other than Solidity from the same `Cheatcodes` model, so that
+# tooling in other languages can load a pre-built table instead of compiling `Vm.sol`.
+# A backend sets `name`, the key it is selected by with `--emit NAME=PATH`, and overrides `emit`,
+# which writes the bindings for `contract` to `out`. Both are checked when the backend is defined.
+class Emitter(ABC):
+    name: str = ""
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        assert cls.name != "", f"{cls.__name__} must set a name"
+        assert not getattr(cls.emit, "__isabstractmethod__", False), f"{cls.__name__} must override emit"
+
+    @abstractmethod
+    def emit(self, contract: Cheatcodes, out: "TextIO"):
+        ...
+
+
+class AbiJsonEmitter(Emitter):
+    name = "abi"
+
+    def emit(self, contract: Cheatcodes, out: "TextIO"):
+        json.dump(abi(contract), out, indent=2)
+        out.write("\n")
+
+
+class TypeScriptEmitter(Emitter):
+    name = "ts"
+
+    def emit(self, contract: Cheatcodes, out: "TextIO"):
+        out.write(GENERATED_HEADER + "\n")
+        out.write(f"export const vmAbi = {json.dumps(abi(contract), indent=2)} as const;\n\n")
+        out.write("export const vmSelectors = {\n")
+        for cc in contract.cheatcodes:
+            out.write(f"  {json.dumps(cc.func.signature)}: {json.dumps(cc.func.selector)},\n")
+        out.write("} as const;\n\n")
+        out.write("export type VmFunctionName = Extract<(typeof vmAbi)[number], { type: \"function\" }>[\"name\"];\n")
+        out.write("export type VmSignature = keyof typeof vmSelectors;\n")
+
+
+class PythonEmitter(Emitter):
+    name = "py"
+
+    def emit(self, contract: Cheatcodes, out: "TextIO"):
+        out.write(PY_GENERATED_HEADER + "\n")
+        out.write("from typing import Any\n\n")
+        out.write(f"ABI: list[dict[str, Any]] = {abi(contract)!r}\n\n")
+        out.write("SELECTORS: dict[str, str] = {\n")
+        for cc in contract.cheatcodes:
+            out.write(f"    {cc.func.signature!r}: {cc.func.selector!r},\n")
+        out.write("}\n")
+
+
+EMITTERS: dict[str, type[Emitter]] = {e.name: e for e in [AbiJsonEmitter, TypeScriptEmitter, PythonEmitter]}
+
+
+def abi(contract: Cheatcodes) -> list[dict]:
+    structs = {s.name: s for s in contract.structs}
+    enums = {e.name for e in contract.enums}
+
+    def params(decl_params: str, indexed: bool = False) -> list[dict]:
+        return [abi_param(p, structs, enums, indexed) for p in split_params(decl_params)]
+
+    entries = []
+    for error in contract.errors:
+        head, ps, _ = split_declaration(error.declaration)
+        entries.append({"type": "error", "name": head.split()[-1], "inputs": params(ps)})
+    for event in contract.events:
+        head, ps, attrs = split_declaration(event.declaration)
+        entries.append(
+            {
+                "type": "event",
+                "name": head.split()[-1],
+                "inputs": params(ps, indexed=True),
+                "anonymous": "anonymous" in attrs,
+            }
+        )
+    for cc in contract.cheatcodes:
+        head, ps, attrs = split_declaration(cc.func.declaration)
+        outputs = []
+        for attr in attrs:
+            if attr.startswith("returns"):
+                outputs = params(attr[len("returns") :].strip()[1:-1])
+        if "payable" in attrs:
+            mutability = "payable"
+        else:
+            mutability = str(cc.func.mutability) or "nonpayable"
+        entries.append(
+            {
+                "type": "function",
+                "name": head.split()[-1],
+                "inputs": params(ps),
+                "outputs": outputs,
+                "stateMutability": mutability,
+            }
+        )
+    return entries
+
+
+# `uint256[] calldata values` -> `{"name": "values", "type": "uint256[]", "internalType": "uint256[]"}`,
+# with structs expanded into tuples and enums lowered to `uint8`.
+def abi_param(param: str, structs: dict[str, Struct], enums: set[str], indexed: bool = False) -> dict:
+    tokens = param.split()
+    ty = tokens[0]
+    rest = [t for t in tokens[1:] if t not in ("memory", "calldata", "storage", "payable")]
+    ret = {"name": ""}
+    if indexed:
+        ret["indexed"] = "indexed" in rest
+        rest = [t for t in rest if t != "indexed"]
+    if rest:
+        ret["name"] = rest[-1]
+
+    base = ty.split("[", 1)[0]
+    dims = ty[len(base) :]
+    if base in structs:
+        ret["type"] = "tuple" + dims
+        ret["internalType"] = f"struct VmSafe.{ty}"
+        ret["components"] = [abi_param(f"{f.ty} {f.name}", structs, enums) for f in structs[base].fields]
+    elif base in enums:
+        ret["type"] = "uint8" + dims
+        ret["internalType"] = f"enum VmSafe.{ty}"
+    else:
+        canonical = {"uint": "uint256", "int": "int256"}.get(base, base)
+        ret["type"] = canonical + dims
+        ret["internalType"] = canonical + dims
+    return ret
 
 
 if __name__ == "__main__":
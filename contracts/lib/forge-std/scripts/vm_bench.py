@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from vm import (
+    FOUNDRY_TOML,
+    OUT_PATH,
+    Cheatcode,
+    Cheatcodes,
+    CheatcodesPrinter,
+    PhaseHook,
+    Phases,
+    TimingHook,
+    generate_phases,
+    keccak256_batch,
+    partition_cheatcodes,
+    target_digest,
+    verify_selectors,
+    vm_printer_options,
+    write_vm,
+)
+
+GROUPS = [
+    "crypto",
+    "environment",
+    "evm",
+    "filesystem",
+    "json",
+    "scripting",
+    "string",
+    "testing",
+    "toml",
+    "utilities",
+]
+FORGE_STD = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark scripts/vm.py on a synthetic spec")
+    parser.add_argument("-n", "--cheatcodes", type=int, default=50_000, help="number of synthetic cheatcodes")
+    parser.add_argument(
+        "--baseline",
+        action="store_true",
+        help="also time the implementations these replaced, e.g. the quadratic string-concatenating printer",
+    )
+    parser.add_argument("--snapshots", type=int, default=100, help="number of specs held in memory at once")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        nargs="+",
+        default=sorted({1, os.cpu_count() or 1}),
+        help="process counts to render Vm.sol with",
+    )
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        metavar="N",
+        help="instead, time each phase of a regeneration from specs N times the size of src/Vm.sol",
+    )
+    parser.add_argument("--phases-of", metavar="PATH", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phases_of:
+        phases(args.phases_of)
+        return
+    if args.scales:
+        scaling(args.scales)
+        return
+
+    self_us, total_us, heaviest = import_time()
+    print(f"{'import vm':<24} {total_us / 1000:10.1f} ms ({self_us / 1000:.1f} ms in vm itself)")
+    for us, name in heaviest:
+        print(f"  {name:<22} {us / 1000:10.1f} ms")
+
+    contract = Cheatcodes.from_dict(synthetic_spec(args.cheatcodes))
+    print(f"{len(contract.cheatcodes)} cheatcodes")
+
+    snapshot = json.dumps(synthetic_spec(1_000))
+    bench(f"load {args.snapshots} x 1k specs", lambda: load_snapshots(snapshot, args.snapshots), args.snapshots * 1_000)
+
+    if args.baseline:
+        bench("sort (CmpCheatcode)", lambda: cmp_partition(contract.cheatcodes), len(contract.cheatcodes))
+    bench("sort (tuple key)", lambda: partition_cheatcodes(contract.cheatcodes), len(contract.cheatcodes))
+
+    if args.baseline:
+        bench("printer (concatenating)", lambda: print_contract(ConcatPrinter(), contract), len(contract.cheatcodes))
+    bench("printer (chunked)", lambda: print_contract(CheatcodesPrinter(), contract), len(contract.cheatcodes))
+    bench("printer (stream)", lambda: stream_contract(contract), len(contract.cheatcodes))
+    print(f"{'printer calls per line':<24} {printer_calls_per_line(contract):10.1f}")
+
+    safe, unsafe = partition_cheatcodes(contract.cheatcodes)
+    for jobs in args.jobs:
+        bench(f"render Vm.sol ({jobs} jobs)", lambda: render_vm(contract, safe, unsafe, jobs), len(contract.cheatcodes))
+
+
+def bench(name: str, f, n: int):
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    result = f()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    print(
+        f"{name:<24} {elapsed * 1000:10.1f} ms {n / elapsed:12.0f} cheatcodes/s"
+        f" {peak / 2**20:10.1f} MiB peak {retained / 2**20:10.1f} MiB retained"
+    )
+
+
+# Best of `runs` fresh `import vm`s according to `python -X importtime`: the time spent in vm
+# itself, the total, and the heaviest modules it imported directly. vm's own time includes
+# compiling it when bytecode is not cached, e.g. with PYTHONDONTWRITEBYTECODE set.
+def import_time(runs: int = 5) -> tuple[int, int, list[tuple[int, str]]]:
+    best = None
+    for _ in range(runs):
+        res = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import vm"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        # Lines look like `import time: <self us> | <cumulative us> | <indented name>`, with
+        # each module listed after the modules it imported.
+        imports = []
+        for line in res.stderr.splitlines():
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_us, total_us, name = line.removeprefix("import time:").split("|")
+            imports.append((int(self_us), int(total_us), name))
+        depth = lambda name: len(name) - len(name.lstrip())
+        vm_idx = next(i for i, (_, _, name) in enumerate(imports) if name.strip() == "vm")
+        vm_self, vm_total, vm_name = imports[vm_idx]
+        direct = []
+        for _, total, name in reversed(imports[:vm_idx]):
+            if depth(name) <= depth(vm_name):
+                break
+            if depth(name) == depth(vm_name) + 2:
+                direct.append((total, name.strip()))
+        if best is None or vm_total < best[1]:
+            best = (vm_self, vm_total, sorted(direct, reverse=True)[:5])
+    return best
+
+
+# Writes a synthetic spec for each scale and times its phases in a fresh process, so that each
+# gets its own peak RSS.
+def scaling(scales: list[int]):
+    base = current_size()
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            n = base * scale
+            path = os.path.join(tmp, f"cheatcodes-{scale}x.json")
+            with open(path, "w") as f:
+                json.dump(synthetic_spec(n), f)
+            print(f"{scale}x: {n} cheatcodes, {os.path.getsize(path) / 2**20:.1f} MiB spec")
+            subprocess.run([sys.executable, __file__, "--phases-of", path], check=True)
+
+
+# Number of functions in the checked-in `src/Vm.sol`.
+def current_size() -> int:
+    path = os.path.join(FORGE_STD, OUT_PATH)
+    with open(path, "r") as f:
+        return sum(1 for line in f if line.lstrip().startswith("function "))
+
+
+# Times the phases of a regeneration of `src/Vm.sol` from the spec at `path`, by running the same
+# `generate_phases` as `vm.py` into a scratch checkout with forge-std's `foundry.toml`. The model
+# cache is bypassed so that parsing is timed.
+def phases(path: str):
+    timing, rss = TimingHook(), RssHook()
+    phases = Phases("bench", [timing, rss])
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, os.path.dirname(OUT_PATH)))
+        shutil.copy(os.path.join(FORGE_STD, FOUNDRY_TOML), os.path.join(root, FOUNDRY_TOML))
+
+        with phases("read"), open(path, "rb") as f:
+            spec = f.read()
+        with phases("input hash"):
+            digest = target_digest(spec, root, "default")
+        with phases("parse"):
+            contract = Cheatcodes.from_json(spec).materialize()
+        with phases("verify selectors"):
+            verify_selectors(contract.cheatcodes)
+        out_path = os.path.join(root, OUT_PATH)
+        generate_phases(contract, root, out_path, "default", digest, False, False, 1, False, False, phases)
+
+    n = len(contract.cheatcodes)
+    for (name, elapsed, _, _), peak in zip(timing.phases, rss.peaks):
+        print(f"  {name:<22} {elapsed * 1000:10.1f} ms {n / elapsed:12.0f} cheatcodes/s {peak:10.1f} MiB peak RSS")
+    total = sum(elapsed for _, elapsed, _, _ in timing.phases)
+    print(f"  {'total':<22} {total * 1000:10.1f} ms {n / total:12.0f} cheatcodes/s")
+
+
+# Peak RSS of the process after each phase, in MiB.
+class RssHook(PhaseHook):
+    peaks: list[float]
+
+    def __init__(self):
+        self.peaks = []
+
+    def exit(self, name: str):
+        self.peaks.append(peak_rss())
+
+
+def peak_rss() -> float:
+    # `ru_maxrss` is in KiB on Linux and in bytes on macOS.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+# Keeps every parsed spec alive, like a tool diffing many historical releases would. Only the
+# cheatcodes are accessed, the other sections stay unparsed.
+def load_snapshots(snapshot: str, n: int) -> list[Cheatcodes]:
+    contracts = [Cheatcodes.from_json(snapshot) for _ in range(n)]
+    for contract in contracts:
+        contract.cheatcodes
+    return contracts
+
+
+def render_vm(contract: Cheatcodes, safe: list[Cheatcode], unsafe: list[Cheatcode], jobs: int):
+    options = vm_printer_options(FORGE_STD)
+    with open(os.devnull, "w") as f:
+        if jobs == 1:
+            write_vm(f, contract, safe, unsafe, "", options)
+            return
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            write_vm(f, contract, safe, unsafe, "", options, executor)
+
+
+def print_contract(pp: CheatcodesPrinter, contract: Cheatcodes) -> str:
+    pp.p_contract(contract, "Vm")
+    return pp.finish()
+
+
+def stream_contract(contract: Cheatcodes):
+    with open(os.devnull, "w") as f:
+        print_contract(CheatcodesPrinter(out=f, memory_to_calldata=True), contract)
+
+
+# The printer as it was before it switched to a chunk list, kept as a baseline: every piece of
+# output is appended to a single str, which CPython has to copy each time since the attribute
+# holds a second reference to it.
+class ConcatPrinter(CheatcodesPrinter):
+    _buffer: str
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._buffer = ""
+        self._chunks = ConcatChunks(self)
+
+    @property
+    def buffer(self) -> str:
+        return self._buffer
+
+    def finish(self) -> str:
+        ret = self._buffer.rstrip()
+        self._buffer = ""
+        return ret
+
+    def _flush(self):
+        pass
+
+    def _trim_blank_lines(self):
+        stripped = self._buffer.rstrip()
+        if stripped != self._buffer:
+            self._buffer = stripped + self.nl_str
+
+
+# Stands in for `CheatcodesPrinter._chunks`, concatenating what is appended onto the printer's buffer.
+class ConcatChunks:
+    printer: ConcatPrinter
+
+    def __init__(self, printer: ConcatPrinter):
+        self.printer = printer
+
+    def append(self, txt: str):
+        self.printer._buffer += txt
+
+
+# Python function calls made by the printer for each line of output.
+def printer_calls_per_line(contract: Cheatcodes) -> float:
+    pp = CheatcodesPrinter(**vm_printer_options(FORGE_STD))
+    profile = cProfile.Profile()
+    profile.enable()
+    out = print_contract(pp, contract)
+    profile.disable()
+    return pstats.Stats(profile).total_calls / (out.count("\n") + 1)
+
+
+# How cheatcodes were sorted before `cheatcode_sort_key`, kept as a baseline.
+def cmp_partition(cheatcodes: list[Cheatcode]) -> tuple[list[Cheatcode], list[Cheatcode]]:
+    ccs = list(filter(lambda cc: cc.status not in ["experimental", "internal"], cheatcodes))
+    ccs.sort(key=lambda cc: cc.func.id)
+    safe = list(filter(lambda cc: cc.safety == "safe", ccs))
+    safe.sort(key=CmpCheatcode)
+    unsafe = list(filter(lambda cc: cc.safety == "unsafe", ccs))
+    unsafe.sort(key=CmpCheatcode)
+    return safe, unsafe
+
+
+class CmpCheatcode:
+    cheatcode: Cheatcode
+
+    def __init__(self, cheatcode: Cheatcode):
+        self.cheatcode = cheatcode
+
+    def __lt__(self, other: "CmpCheatcode") -> bool:
+        a, b = self.cheatcode, other.cheatcode
+        if a.group != b.group:
+            return a.group < b.group
+        if a.status != b.status:
+            return a.status < b.status
+        if a.safety != b.safety:
+            return a.safety < b.safety
+        return a.func.id < b.func.id
+
+
+def synthetic_spec(n: int) -> dict:
+    signatures = [f"cheat{i}(string,uint256)" for i in range(n)]
+    selectors = [digest[:4] for digest in keccak256_batch([s.encode("utf-8") for s in signatures])]
+    cheatcodes = []
+    for i in range(n):
+        selector = selectors[i]
+        cheatcodes.append(
+            {
+                "func": {
+                    "id": f"cheat{i}",
+                    "description": f"Synthetic cheatcode number {i}.\nDoes nothing.",
+                    "declaration": f"function cheat{i}(string calldata key, uint256 value) external view returns (bytes memory out);",
+                    "visibility": "external",
+                    "mutability": "view",
+                    "signature": signatures[i],
+                    "selector": "0x" + selector.hex(),
+                    "selectorBytes": list(selector),
+                },
+                "group": GROUPS[i % len(GROUPS)],
+                "status": "stable",
+                "safety": "safe" if i % 4 else "unsafe",
+            }
+        )
+    return {
+        "errors": [],
+        "events": [],
+        "enums": [],
+        "structs": [],
+        "cheatcodes": cheatcodes,
+    }
+
+
+if __name__ == "__main__":
+    main()
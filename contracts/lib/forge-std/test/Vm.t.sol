@@ -6,8 +6,9 @@ import {Vm, VmSafe} from "../src/Vm.sol";
 
 contract VmTest is Test {
     // This test ensures that functions are never accidentally removed from a Vm interface, or
-    // inadvertently moved between Vm and VmSafe. This test must be updated each time a function is
-    // added to or removed from Vm or VmSafe.
+    // inadvertently moved between Vm and VmSafe. scripts/vm.py verifies the expected IDs without
+    // compiling and refuses to regenerate Vm.sol if they changed; after an intended change,
+    // `scripts/vm.py --update-interface-ids` rewrites them.
     function test_interfaceId() public pure {
         assertEq(type(VmSafe).interfaceId, bytes4(0x5c59cbde), "VmSafe");
         assertEq(type(Vm).interfaceId, bytes4(0x1316b43e), "Vm");